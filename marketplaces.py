@@ -10,8 +10,12 @@ import random
 import requests
 import traceback
 import html
+import threading
+import re
+import hashlib
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # pip packages
 import lxml.html as lh
@@ -19,6 +23,12 @@ import lxml.html as lh
 import program.library.helpers as helpers
 
 from program.library.database import Database
+from program.library.bloomfilter import BloomFilter
+from program.library.phrasematcher import PhraseMatcher
+from program.library.nearduplicates import NearDuplicates
+from program.library.queryplanner import QueryPlanner
+from program.library.cityscheduler import CityScheduler
+from program.library.budgetallocator import BudgetAllocator
 from program.library.api import Api
 from program.library.aws import Aws
 from program.library.sendgrid import SendGrid
@@ -77,6 +87,7 @@ class Checkaflip:
             'idInWebsite': self.getId(keyword),
             'keyword': item.get('keyword', ''),
             'gmDate': str(datetime.datetime.utcnow()),
+            'gmTimestamp': int(time.time()),
             'price': averagePrice,
             'json': json.dumps(jsonColumn)
         }
@@ -121,16 +132,190 @@ class Checkaflip:
         return result
 
     def __init__(self, options):
-        self.api = Api('http://www.checkaflip.com')
-
         self.options = options
 
+        self.api = Api('http://www.checkaflip.com', self.options)
+
         self.internet = Internet(self.options)
 
+# csv and html output for one keyword for one day. rows are appended without rewriting the files.
+class Report:
+    def add(self, fields):
+        line = ','.join(fields)
+
+        for file in self.csvFiles:
+            file.write(line + '\n')
+            file.flush()
+
+        row = OrderedDict(zip(self.headers, fields))
+
+        if not row.get('picture', ''):
+            return
+
+        self.appendToHtml(self.getHtmlRow(row))
+
+    # the html file ends with a fixed tail. new rows go right before it.
+    def appendToHtml(self, rowHtml):
+        data = rowHtml.encode('utf-8')
+
+        self.htmlFile.seek(self.htmlTailOffset)
+        self.htmlFile.write(data + self.htmlTail)
+        self.htmlFile.truncate()
+        self.htmlFile.flush()
+
+        self.htmlTailOffset += len(data)
+
+    def getHtmlRow(self, row):
+        result = '        <tr>\n'
+
+        for column in row:
+            value = row[column]
+
+            if column == 'url':
+                value = f'<a href="{value}" target="_blank">{value}</a>'
+            elif column == 'email':
+                shortUrl = helpers.findBetween(value, 'mailto:', '?')
+                
+                value = f'''
+                    <p>
+                        <a href="{value}">{shortUrl}</a>
+                    </p>
+                    <p>
+                        <button id="1" type="button" class="btn btn-outline-secondary choose-item unselected" data-email="{shortUrl}">Select</button>
+                    </p>
+                    '''
+            elif column == 'picture':
+                value = f'<a href="{value}" target="_blank"><img src="{value}"/></a>'
+            else:
+                value = html.escape(value, quote=False)
+
+            result += f'            <td>{value}</td>\n'
+
+        result += '        </tr>\n'
+
+        return result
+
+    # fills in everything except the table once. returns what goes before and after the table.
+    def compileTemplate(self):
+        file = helpers.getFile('program/resources/template.html')
+
+        emailBodyFile = 'user-data/input/' + self.searchItem.get('email body', 'email.html')
+        emailSubjectFile = 'user-data/input/' + self.searchItem.get('email subject', 'subject.txt')
+
+        emailVariables = {
+            'keyword': self.searchItem.get('keyword', '')
+        }
+
+        message = helpers.getFile(emailBodyFile)
+        message = helpers.replaceVariables(message, emailVariables, '$')
+
+        subject = helpers.getFile(emailSubjectFile)
+        subject = helpers.replaceVariables(subject, emailVariables, '$')
+
+        variables = {
+            'subject': subject,
+            'message': message,
+            'subjectEscaped': html.escape(subject),
+            'messageEscaped': html.escape(message)
+        }
+
+        file = helpers.replaceVariables(file, variables, '%')
+
+        before = helpers.findBetween(file, '', '%table%')
+        after = helpers.findBetween(file, '%table%', '', True)
+
+        return before, after
+
+    def open(self):
+        isNew = not os.path.exists(self.fileName)
+
+        existingRows = []
+
+        # from an earlier run today
+        if not isNew:
+            existingRows = helpers.getCsvFile(self.fileName)
+
+        self.csvFiles = [
+            open(self.fileName, 'a', encoding='utf-8'),
+            open(self.fileName + '-backup.csv', 'a', encoding='utf-8')
+        ]
+
+        if isNew:
+            line = ','.join(self.headers)
+
+            for file in self.csvFiles:
+                file.write(line + '\n')
+
+        before, after = self.compileTemplate()
+
+        head = '<table>\n'
+        head += '    <thead>\n'
+        head += '        <tr>\n'
+
+        for column in self.headers:
+            head += f'            <th>{column}</th>\n'
+
+        head += '        </tr>\n'
+        head += '    </thead>\n'
+        head += '    <tbody>\n'
+
+        for row in existingRows:
+            if not row.get('picture', ''):
+                continue
+
+            head += self.getHtmlRow(row)
+
+        tail = '    </tbody>\n'
+        tail += '</table>'
+
+        head = (before + head).encode('utf-8')
+        self.htmlTail = (tail + after + '\n').encode('utf-8')
+
+        htmlFileName = helpers.fileNameOnly(self.fileName, False) + '.html'
+        htmlFileName = self.options['outputDirectory'] + '/' + htmlFileName
+
+        self.htmlFile = open(htmlFileName, 'w+b')
+        self.htmlFile.write(head + self.htmlTail)
+        self.htmlFile.flush()
+
+        self.htmlTailOffset = len(head)
+
+    def flush(self):
+        for file in self.csvFiles:
+            file.flush()
+
+    def close(self):
+        for file in self.csvFiles:
+            file.close()
+
+        self.htmlFile.close()
+
+    def __init__(self, options, searchItem, fileName, headers):
+        self.options = options
+        self.searchItem = searchItem
+        self.fileName = fileName
+        self.headers = headers
+        self.csvFiles = []
+        self.htmlFile = None
+        self.htmlTail = b''
+        self.htmlTailOffset = 0
+
+        self.open()
+
 class Craigslist:
-    def getResults(self, site, item, page, database):
+    # status says how many rows the page had and whether the following pages can have anything new
+    def getResults(self, site, item, page, database, newestIdLastTime='', status=None):
         results = []
 
+        if status is None:
+            status = {}
+
+        status['rows'] = 0
+        status['reachedEnd'] = False
+
+        # whether the last row was checked before
+        lastWasSeen = False
+
         document = lh.fromstring(page)
 
         # get items
@@ -143,11 +328,15 @@ class Craigslist:
             
             if 'ban nearby' in element.attrib['class']:
                 logging.info("Stopping. Found few local results message.")
+                status['reachedEnd'] = True
                 break
 
             if element.tag != 'li':
                 continue
 
+            status['rows'] += 1
+            lastWasSeen = True
+
             newItem = {}
     
             newItem['siteName'] = helpers.getDomainName(site)
@@ -159,172 +348,1351 @@ class Craigslist:
             newItem['price'] = self.toDollars(newItem['price'])
             
             newItem['gmDate'] = str(datetime.datetime.utcnow())
+            newItem['gmTimestamp'] = int(time.time())
+
+            newItem['idInWebsite'] = self.getId(newItem['url'])
+
+            # renewed listings move back to the top, so newer listings can come after them
+            if self.isOlder(newItem['idInWebsite'], newestIdLastTime):
+                logging.info(f'Skipping. {newItem["idInWebsite"]} was checked last time.')
+                continue
+
+            # avoid duplicates
+            if self.isInDatabase(site, newItem, database):
+                if self.options['incrementalCrawl'] == 1:
+                    continue
+
+                logging.info('Stopping. Already saw the subsequent results.')
+                status['reachedEnd'] = True
+                break
+
+            lastWasSeen = False
+
+            if newItem['price'] <= 0:
+                logging.info('Skipping price is less than or equal to zero')
+                self.countDrop('price')
+                continue
+
+            results.append(newItem)
+
+            price = newItem['price']
+            name = newItem['name']
+
+            logging.info(f'Results: {len(results)}. Name: {name}. Price: {price}.')
+
+        # newest first, so the next pages only have older listings
+        if lastWasSeen and self.options['incrementalCrawl'] == 1:
+            status['reachedEnd'] = True
+
+        return results
+
+    # a generator, so later pages are only downloaded if the listings before them were all used.
+    # walk['complete'] says whether it got to the end of the results or stopped at maximumPagesPerCity or a failed page.
+    def getAllResults(self, site, item, page, urlToGet, database, newestIdLastTime, walk):
+        walk['complete'] = False
+
+        offset = 0
+
+        for pageIndex in range(max(1, self.options['maximumPagesPerCity'])):
+            if pageIndex > 0:
+                logging.info(f'Getting page {pageIndex + 1} of the results')
+                self.countRequests(item, 1)
+                page = self.api.get(f'{urlToGet}&s={offset}', None, False)
+
+                if not page:
+                    break
+
+            status = {}
+
+            for newItem in self.getResults(site, item, page, database, newestIdLastTime, status):
+                yield newItem
+
+            offset += status['rows']
+
+            if status['reachedEnd'] or status['rows'] == 0 or offset >= self.getTotalCount(page):
+                walk['complete'] = True
+                break
+
+    def getTotalCount(self, page):
+        result = 0
+
+        if not page:
+            return result
+
+        totalCount = helpers.findBetween(page, '<span class="totalcount">', '</span>', True)
+
+        if totalCount.isdigit():
+            result = int(totalCount)
+
+        return result
+    
+    def search(self, onItemIndex, site, item, database, averageSellingPrice):
+        if not averageSellingPrice:
+            return
+
+        self.averageSellingPrices[self.planner.normalize(item.get('keyword', ''))] = averageSellingPrice
+
+        minimumPrice, maximumPrice = self.getPriceRange(item, averageSellingPrice)
+
+        planner = QueryPlanner(self.options)
+        planner.add(site, item, minimumPrice, maximumPrice)
+
+        for query in planner.getQueries():
+            self.searchQuery(onItemIndex, site, query, database)
+
+    # input rows are collected first, so rows that can share a search only need one
+    def addToPlan(self, site, item, averageSellingPrice):
+        if not averageSellingPrice:
+            return
+
+        self.averageSellingPrices[self.planner.normalize(item.get('keyword', ''))] = averageSellingPrice
+
+        minimumPrice, maximumPrice = self.getPriceRange(item, averageSellingPrice)
+
+        self.planner.add(site, item, minimumPrice, maximumPrice)
+
+    def getPlan(self):
+        return self.planner.getQueries()
+
+    def finishPlan(self, queries):
+        logging.info(self.planner.getSummary(queries))
+
+        self.planner = QueryPlanner(self.options)
+
+    def getPriceRange(self, item, averageSellingPrice):
+        minimumPrice = item.get('min price', '')
+        minimumPrice = int(minimumPrice)
+
+        minimumProfit = item.get('min profit', 10)
+        minimumProfit = int(minimumProfit)
+
+        shipping = item.get('shipping cost', 0)
+        shipping = float(shipping)
+
+        # don't want items that cost more than the selling price
+        priceWant = averageSellingPrice - minimumProfit - shipping
+        priceWant = int(round(priceWant))
+
+        maximumPrice = priceWant
+
+        if priceWant < minimumPrice:
+            minimumPrice = 1
+
+        return minimumPrice, maximumPrice
+
+    def searchQuery(self, onItemIndex, site, item, database):
+        self.hasNotifiedForThisSearch = False
+
+        self.api.proxies = self.internet.getRandomProxy()
+
+        keyword = item.get('keyword', '')
+
+        minimumPrice = item['minimumPrice']
+        maximumPrice = item['maximumPrice']
+
+        self.resultCounts = {}
+        self.shouldStop = False
+        self.leftForNextTime = set()
+        self.pendingWatermarks = []
+        self.pendingPriceBands = []
+        self.dropCounts = {}
+        self.nearDuplicates = NearDuplicates(database)
+        self.cityScheduler = CityScheduler(database, self.options)
+
+        cities = []
+
+        for city in self.siteInformation['cities']:
+            if '--debug' in sys.argv and city.get('url', '') == 'https://albuquerque.craigslist.org':
+                logging.info('Stopping')
+                break
+
+            cities.append(city)
+
+        cities = self.cityScheduler.getCities(helpers.getDomainName(site), item, cities)
+
+        maximumWorkers = max(1, self.options['maximumWorkers'])
+
+        if maximumWorkers > 1:
+            logging.info(f'Keyword {onItemIndex}: {keyword}. Searching {len(cities)} cities with {maximumWorkers} workers.')
+
+        self.startPictureStage()
+
+        try:
+            with ThreadPoolExecutor(max_workers=maximumWorkers) as executor:
+                futures = []
+
+                for i, city in enumerate(cities):
+                    future = executor.submit(self.searchCity, onItemIndex, i, city, site, item, database, minimumPrice, maximumPrice)
+                    futures.append(future)
+
+                for future in futures:
+                    future.result()
+        finally:
+            # a picture worker's error mustn't lose what the search learned
+            try:
+                self.stopPictureStage()
+            finally:
+                self.finishSearch(database)
+
+    # also runs after an error, so what the cities that finished learned is kept
+    def finishSearch(self, database):
+        self.cityScheduler.save()
+
+        # listings that were left for next time must not be below a watermark
+        if self.shouldStop:
+            self.pendingWatermarks = []
+
+        for watermark in self.pendingWatermarks:
+            if watermark['city'] in self.leftForNextTime:
+                continue
+
+            database.insertLater('crawlWatermark', watermark)
+
+        for priceBand in self.pendingPriceBands:
+            database.insertLater('priceBand', priceBand)
+
+        self.pendingWatermarks = []
+        self.pendingPriceBands = []
+
+        database.flush()
+
+        self.closeReports()
+
+        if self.dropCounts:
+            logging.info(self.getDropSummary())
+
+        for keyword, count in self.resultCounts.items():
+            if self.enoughResults({'keyword': keyword}):
+                logging.info(f'Reached maximum of {count} results for {keyword}.')
+
+        reason = self.api.requestBudget.getExhaustedReason()
+
+        if reason:
+            logging.info(f'Stopping. {reason}.')
+
+    def searchCity(self, onItemIndex, i, city, site, item, database, minimumPrice, maximumPrice):
+        if self.isFinished(item):
+            return
+
+        try:
+            keyword = item.get('keyword', '')
+
+            cityName = city.get('name', '')
+
+            logging.info(f'Keyword {onItemIndex}: {keyword}. Site: craigslist. City {i + 1}: {cityName}. Price: {minimumPrice} to {maximumPrice}.')
+
+            wholeRange = self.getPriceBand(city, item, minimumPrice, maximumPrice, self.getPages(item, [self.getSearchUrl(city, item, minimumPrice, maximumPrice)])[0])
+
+            if wholeRange['page']:
+                self.cityScheduler.addPoll(city.get('url', ''))
+
+            bands = self.getPriceBands(site, city, item, database, wholeRange)
+
+            complete = True
+
+            for band in bands:
+                if self.isFinished(item):
+                    self.leaveForNextTime(city.get('url', ''))
+                    complete = False
+                    break
+
+                if not self.searchPriceBand(site, city, item, database, band, minimumPrice, maximumPrice):
+                    complete = False
+
+            # next time the first page of the whole range is enough when not much is new
+            if complete and len(bands) > 1 and self.options['incrementalCrawl'] == 1:
+                ids = self.getPageIds(wholeRange['page'])
+                self.addWatermark(site, city, item, minimumPrice, maximumPrice, self.getFingerprint(ids), self.getNewestId(ids))
+        except Exception as e:
+            # so the other workers stop too
+            self.shouldStop = True
+            raise e
+
+    def searchPriceBand(self, site, city, item, database, band, minimumPrice, maximumPrice):
+        incremental = self.options['incrementalCrawl'] == 1
+
+        page = band['page']
+
+        if not page:
+            logging.error(f'Failed to get {band["url"]}')
+            self.leaveForNextTime(city.get('url', ''))
+            return False
+
+        watermark = {}
+        ids = self.getPageIds(page)
+        fingerprint = self.getFingerprint(ids)
+
+        if incremental:
+            watermark = self.getWatermark(site, city, item, band['minimumPrice'], band['maximumPrice'], database)
+
+        if watermark and watermark['fingerprint'] == fingerprint:
+            logging.info(f'Skipping {city.get("name", "")} from {band["minimumPrice"]} to {band["maximumPrice"]}. Same listings as last time.')
+            return True
+
+        walk = {}
+
+        items = self.getAllResults(site, item, page, band['url'], database, helpers.get(watermark, 'newestId'), walk)
+
+        complete = True
+
+        for newItem in items:
+            if self.isFinished(item):
+                complete = False
+                break
+
+            self.cityScheduler.addListing(city.get('url', ''))
+
+            self.processResult(site, item, newItem, database, city.get('url', ''))
+
+        if not complete:
+            self.leaveForNextTime(city.get('url', ''))
+        # more pages were left. the previous watermark stays, so they aren't mistaken for seen next time.
+        elif not walk['complete']:
+            complete = False
+        elif incremental:
+            self.addWatermark(site, city, item, band['minimumPrice'], band['maximumPrice'], fingerprint, self.getNewestId(ids))
+
+        return complete
+
+    def getSearchUrl(self, city, item, minimumPrice, maximumPrice):
+        keywords = urllib.parse.quote_plus(item.get('keyword', ''))
+
+        # sss means all for sale
+        category = item.get('craigslist category', 'sss')
+
+        # newest first is stable between runs, so the previous run's listings are all at the end
+        sort = 'rel'
+
+        if self.options['incrementalCrawl'] == 1:
+            sort = 'date'
+
+        result = city.get('url', '')
+        result += f'/search/{category}?query={keywords}&sort={sort}&min_price={minimumPrice}&max_price={maximumPrice}'
+
+        return result
+
+    # splits the price range until each part fits on one page of results. the parts are downloaded at the same time.
+    # starts from the parts that were needed last time, so busy cities don't need to be split again.
+    # only splits when there are more results than one page holds and they aren't mostly known already
+    def getPriceBands(self, site, city, item, database, wholeRange):
+        result = [wholeRange]
+
+        if wholeRange['count'] <= self.resultsPerPage or self.reachesLastTime(site, city, item, database, wholeRange):
+            return result
+
+        result = []
+
+        minimumPrice = wholeRange['minimumPrice']
+        maximumPrice = wholeRange['maximumPrice']
+        maximumBands = max(1, self.options['maximumPriceBands'])
+
+        toGet = self.getLearnedPriceBands(site, city, item, database, minimumPrice, maximumPrice)
+
+        while toGet:
+            # already have the whole range
+            toFetch = [band for band in toGet if band != (minimumPrice, maximumPrice)]
+            pages = dict(zip(toFetch, self.getPages(item, [self.getSearchUrl(city, item, band[0], band[1]) for band in toFetch])))
+
+            toSplit = []
+
+            for band in toGet:
+                if band == (minimumPrice, maximumPrice):
+                    newBand = wholeRange
+                else:
+                    newBand = self.getPriceBand(city, item, band[0], band[1], pages.get(band))
+
+                canSplit = band[1] > band[0] and len(result) + len(toSplit) * 2 + 2 <= maximumBands
+
+                if newBand['count'] > self.resultsPerPage and canSplit:
+                    toSplit.append(band)
+                else:
+                    result.append(newBand)
+
+            toGet = []
+
+            for band in toSplit:
+                middle = (band[0] + band[1]) // 2
+
+                logging.info(f'Splitting prices {band[0]} to {band[1]} at {middle}. Too many results for one page.')
+
+                toGet.append((band[0], middle))
+                toGet.append((middle + 1, band[1]))
+
+        result = sorted(result, key=lambda band: band['minimumPrice'])
+
+        self.addPriceBands(site, city, item, result)
+
+        return result
+
+    def getPriceBand(self, city, item, minimumPrice, maximumPrice, page):
+        return {
+            'minimumPrice': minimumPrice,
+            'maximumPrice': maximumPrice,
+            'url': self.getSearchUrl(city, item, minimumPrice, maximumPrice),
+            'page': page,
+            'count': self.getTotalCount(page)
+        }
+
+    # the newest first page goes back to listings from last time
+    def reachesLastTime(self, site, city, item, database, wholeRange):
+        result = False
+
+        if self.options['incrementalCrawl'] != 1:
+            return result
+
+        watermark = self.getWatermark(site, city, item, wholeRange['minimumPrice'], wholeRange['maximumPrice'], database)
+
+        if not watermark:
+            return result
+
+        ids = self.getPageIds(wholeRange['page'])
+
+        if watermark['fingerprint'] == self.getFingerprint(ids):
+            result = True
+        else:
+            result = any(self.isOlder(id, watermark['newestId']) for id in ids)
+
+        return result
+
+    def getPages(self, item, urls):
+        self.countRequests(item, len(urls))
+
+        if len(urls) == 1:
+            return [self.api.get(urls[0], None, False)]
+
+        with ThreadPoolExecutor(max_workers=max(1, self.options['maximumBandWorkers'])) as executor:
+            return list(executor.map(lambda url: self.api.get(url, None, False), urls))
+
+    # for the summary of what the plan saved
+    def countRequests(self, item, count):
+        with self.lock:
+            item['requests'] = item.get('requests', 0) + count
+
+    # joins neighbouring parts that had few results last time
+    def getLearnedPriceBands(self, site, city, item, database, minimumPrice, maximumPrice):
+        result = []
+
+        learnedBands = []
+
+        # each row's share of the results, so rows that are searched together add up
+        for keyword, category in self.getRowKeys(item):
+            row = database.getFirst('priceBand', 'bands', 'siteName = ? and city = ? and keyword = ? and category = ?', parameters=[helpers.getDomainName(site), city.get('url', ''), keyword, category], flush=False)
+
+            if row:
+                learnedBands += json.loads(row['bands'])
+
+        if not learnedBands:
+            return [(minimumPrice, maximumPrice)]
+
+        start = minimumPrice
+        count = 0
+
+        for bandMinimum, bandMaximum, bandCount in sorted(learnedBands):
+            # the price range can be different each time
+            if bandMaximum < minimumPrice or bandMinimum > maximumPrice:
+                continue
+
+            # leave room for new listings
+            if count + bandCount > self.resultsPerPage / 2 and bandMinimum > start:
+                result.append((start, bandMinimum - 1))
+                start = bandMinimum
+                count = 0
+
+            count += bandCount
+
+        result.append((start, maximumPrice))
+
+        return result
+
+    def addPriceBands(self, site, city, item, bands):
+        keys = self.getRowKeys(item)
+
+        with self.lock:
+            for keyword, category in keys:
+                self.pendingPriceBands.append({
+                    'siteName': helpers.getDomainName(site),
+                    'city': city.get('url', ''),
+                    'keyword': keyword,
+                    'category': category,
+                    'bands': json.dumps([[band['minimumPrice'], band['maximumPrice'], round(band['count'] / len(keys), 1)] for band in bands]),
+                    'gmTimestamp': int(time.time())
+                })
+
+    # state is kept for each input row, so it still applies when the rows are searched together differently
+    def getRowKeys(self, item):
+        result = []
+
+        for target in item['targets']:
+            key = (target['keyword'], target['category'])
+
+            if not key in result:
+                result.append(key)
+
+        return result
+
+    # a search can be shared by several input rows. each row that wants the listing checks it with its own filters.
+    # cityUrl is the city whose search found it. nearby cities' listings are in the results too.
+    def processResult(self, site, query, newItem, database, cityUrl=''):
+        listing = self.getNewListing()
+        listing['url'] = newItem.get('url', '')
+        listing['cityUrl'] = cityUrl
+
+        targets = self.planner.getTargets(query, newItem)
+
+        # the keyword can be in the text instead of the title
+        if not targets and len(query['keywords']) > 1:
+            listing['text'] = self.getListingText(listing)
+
+            # the page is needed to know which rows want it
+            if listing['pageFailed']:
+                self.leaveForNextTime(listing['cityUrl'])
+                return
+
+            targets = self.planner.getTargets(query, newItem, listing['text'])
+
+        if not targets:
+            logging.info(f'Skipping. None of the keywords in {query["keyword"]} are in the listing.')
+            self.countDrop('keyword')
+
+            # stored under an input row's keyword, not the whole search
+            item = query['targets'][0]['item']
+            newItem['keyword'] = item.get('keyword', '')
+
+            self.finishListing(site, item, newItem, listing, database)
+            return
+
+        # rows that already have their maximum results drop out of the search. leave the listing for next time.
+        unfinished = [target for target in targets if not self.enoughResults(target['item'])]
+
+        if len(unfinished) < len(targets):
+            self.leaveForNextTime(listing['cityUrl'])
+
+            if not unfinished:
+                return
+
+            targets = unfinished
+
+        price = newItem.get('price', 0)
+
+        inRange = [target for target in targets if target['minimumPrice'] <= price <= target['maximumPrice']]
+
+        # the first row's price check records it
+        if not inRange:
+            inRange = targets[:1]
+
+        for i, target in enumerate(inRange):
+            # each row keeps its own copy of what was found
+            if i > 0:
+                newItem = dict(newItem)
+
+            newItem['keyword'] = target['item'].get('keyword', '')
+
+            self.processListing(site, target['item'], newItem, database, target['minimumPrice'], target['maximumPrice'], listing)
+
+    def processListing(self, site, item, newItem, database, minimumPrice, maximumPrice, loadedListing=None):
+        listing = self.getNewListing(loadedListing)
+        listing['url'] = newItem.get('url', '')
+
+        # no need to download the listing if the search results already rule it out
+        reason = self.getPrefilterReason(item, newItem, minimumPrice, maximumPrice)
+
+        if reason:
+            self.countDrop(reason)
+            self.finishListing(site, item, newItem, listing, database)
+            return
+
+        # a repost of a listing that was already checked and not output gets the same verdict
+        if self.isRepost(item, newItem, listing, 'title'):
+            self.finishListing(site, item, newItem, listing, database)
+            return
+
+        self.loadFeatures(newItem, listing, database)
+
+        if self.isRepost(item, newItem, listing, 'text'):
+            self.finishListing(site, item, newItem, listing, database)
+            return
+
+        self.runSteps(site, item, newItem, listing, database, self.getSteps(item))
+
+    # the title and price are free. the text and picture need the listing's page, which the filters need anyway.
+    def isRepost(self, item, newItem, listing, stage):
+        siteName = newItem.get('siteName', '')
+        scope = self.nearDuplicates.getScope(item)
+        idInWebsite = newItem.get('idInWebsite', '')
+        price = newItem.get('price')
+        hashes = listing['hashes']
+
+        earlier = {}
+
+        if stage == 'title':
+            hashes['title'] = self.nearDuplicates.getSimHash(newItem.get('name', ''), 1, 5)
+
+            earlier = self.nearDuplicates.find(siteName, scope, idInWebsite, 'title', hashes, price)
+        else:
+            # also kept in the feature store so the page isn't needed next time
+            if not 'text' in hashes:
+                if listing['text'] is None:
+                    listing['text'] = self.getListingText(listing)
+
+                if listing['document'] is not None:
+                    hashes['text'] = self.nearDuplicates.getSimHash(self.getPostingBody(listing), 3, 10)
+
+            if listing['pictureUrls'] is None and listing['document'] is not None:
+                listing['pictureUrls'] = self.getPictureUrls(listing)
+
+            if listing['pictureUrls']:
+                hashes['picture'] = self.nearDuplicates.getPictureKey(listing['pictureUrls'][0])
+
+            earlier = self.nearDuplicates.findByPicture(siteName, scope, idInWebsite, hashes, price)
+
+            if not earlier:
+                earlier = self.nearDuplicates.find(siteName, scope, idInWebsite, 'text', hashes, price)
+
+        if not earlier:
+            return False
+
+        # the title alone only saves downloading the page. output is only held back when the text or picture agrees too.
+        if stage == 'title' and self.mayHaveBeenOutput(item, earlier):
+            return False
+
+        listing['duplicateOf'] = earlier['idInWebsite']
+        listing['duplicateMatches'] = bool(earlier['matches'])
+
+        self.countDrop('repost')
+
+        logging.info(f'Skipping. It looks like a repost of {earlier["idInWebsite"]}.')
+
+        return True
+
+    # only whether it matched is stored. that's whether it was output, unless the picture only decides the matches column.
+    def mayHaveBeenOutput(self, item, earlier):
+        if earlier['matches']:
+            return True
+
+        return bool(item.get('picture must contain one of', '')) and self.options['onlyOutputPictureMatches'] == 0
+
+    # the rest of the page is the same for every listing
+    def getPostingBody(self, listing):
+        result = ''
+
+        elements = listing['document'].xpath("//section[@id = 'postingbody']")
+
+        if elements:
+            result = elements[0].text_content()
+            result = result.replace('QR Code Link to This Post', '')
+
+        return result
+
+    # a step is (name, whether failing it rejects the listing)
+    def getSteps(self, item):
+        filters = ['words']
+        others = []
+
+        if item.get('picture must contain one of', ''):
+            # otherwise the picture only decides the matches column
+            if self.options['onlyOutputPictureMatches'] == 1:
+                filters.append('picture')
+            else:
+                others.append('picture')
+
+        result = [(name, True) for name in self.getFilterOrder(filters)]
+        result += [(name, False) for name in others]
+
+        return result
+
+    def runSteps(self, site, item, newItem, listing, database, steps, start=0, handedOff=False):
+        # leave it for next time
+        if handedOff and self.isFinished(item):
+            self.leaveForNextTime(listing['cityUrl'])
+            return
+
+        for i in range(start, len(steps)):
+            name, isFilter = steps[i]
+
+            # this worker moves on to the next listing while the picture is checked
+            if name == 'picture' and not handedOff and self.pictureExecutor:
+                self.submitPicture(site, item, newItem, listing, database, steps, i)
+                return
+
+            passed = self.runStep(name, item, newItem, listing)
+
+            # finishListing leaves it for next time
+            if listing['pageFailed']:
+                break
+
+            listing[name + 'Matches'] = passed
+
+            if passed:
+                continue
+
+            self.countDrop(name)
+
+            if isFilter:
+                break
+
+        self.finishListing(site, item, newItem, listing, database)
+
+    def runStep(self, name, item, newItem, listing):
+        result = False
+
+        # the listing's page is shared by all steps, so it doesn't count towards any one of them
+        if name == 'picture' and listing['pictureUrls'] is None:
+            self.loadListingPage(listing)
+
+        started = time.monotonic()
+
+        if name == 'words':
+            result = self.passesWordFilters(item, newItem, listing)
+        elif name == 'picture':
+            result = self.picturePassesFilters(item, listing)
+
+        self.recordStep(name, result, time.monotonic() - started)
+
+        return result
+
+    def recordStep(self, name, passed, seconds):
+        with self.lock:
+            statistics = self.stepStatistics.get(name)
+
+            if not statistics:
+                statistics = {
+                    'count': 0,
+                    'passed': 0,
+                    'seconds': 0
+                }
+
+                self.stepStatistics[name] = statistics
+
+            statistics['count'] += 1
+            statistics['passed'] += int(passed)
+            statistics['seconds'] += seconds
+
+    # cheapest per rejected listing first. keeps the written order until there's enough data.
+    def getFilterOrder(self, filters):
+        result = filters
+
+        with self.lock:
+            for name in filters:
+                statistics = self.stepStatistics.get(name)
+
+                if not statistics or statistics['count'] < 10:
+                    return result
+
+            result = sorted(filters, key=self.getFilterRank)
+
+        return result
+
+    def getFilterRank(self, name):
+        statistics = self.stepStatistics[name]
+
+        averageSeconds = statistics['seconds'] / statistics['count']
+        rejectionRate = 1 - statistics['passed'] / statistics['count']
+
+        return averageSeconds / max(rejectionRate, 0.01)
+
+    def finishListing(self, site, item, newItem, listing, database):
+        keyword = item.get('keyword', '')
+
+        wordMatches = listing['wordsMatches']
+        pictureMatches = listing['pictureMatches']
+
+        matches = wordMatches and pictureMatches
+
+        # only output to csv/html files if words match
+        output = wordMatches and (pictureMatches or self.options['onlyOutputPictureMatches'] == 0)
+
+        # reposts were already output
+        if listing['duplicateOf']:
+            matches = listing['duplicateMatches']
+            output = False
+
+        newItem['matches'] = int(matches)
+
+        # the page couldn't be downloaded, so the verdict isn't known. leave it for next time.
+        if listing['pageFailed']:
+            self.leaveForNextTime(listing['cityUrl'])
+            return
+
+        # another worker may have reached the maximum first. leave it for next time.
+        if output and not self.reserveResult(item):
+            self.leaveForNextTime(listing['cityUrl'])
+            return
+
+        # only needed for listings that are output
+        if output:
+            if listing['email'] is None:
+                self.loadListingPage(listing)
+
+                if not listing['pageFailed']:
+                    listing['email'] = self.getEmail(newItem, listing['document'])
+
+            self.loadPictureUrls(listing)
+
+            # the request budget ran out first. try again next time.
+            if listing['pageFailed'] or (not listing['email'] and self.api.requestBudget.isExhausted()):
+                self.releaseResult(item)
+                self.leaveForNextTime(listing['cityUrl'])
+                return
+
+        newItem['json'] = {
+            'email': listing['email'] or '',
+            'picture': listing['pictureUrl'],
+            'picture similarity': '',
+            'things in image': listing['thingsInImage']
+        }
+
+        if listing['duplicateOf']:
+            newItem['json']['duplicate of'] = listing['duplicateOf']
+
+        if output:
+            self.outputResult(site, item, newItem, listing)
+
+            if matches:
+                profit = self.getProfit(item, newItem)
+
+                self.cityScheduler.addMatch(item, listing['cityUrl'], profit)
+                self.addValue(item, profit)
+
+            url = newItem.get('url', '')
+            name = newItem.get('name', '')
+            price = newItem.get('price', '')
+
+            self.notify('New result', f'Link: {url}\nKeyword: {keyword}\nTitle: {name}\nPrice: ${price}\n\nCheck the output directory for details.')
+
+        newItem['json'] = json.dumps(newItem['json'])
+
+        # store to database so can skip it next time
+        database.insertLater('result', newItem)
+
+        self.saveFeatures(newItem, listing, database)
+
+        if listing['hashes']:
+            self.nearDuplicates.add(newItem.get('siteName', ''), self.nearDuplicates.getScope(item), newItem.get('idInWebsite', ''), listing['hashes'], newItem.get('price'), newItem['matches'])
+
+        self.addToSeenIndex(site, newItem, database)
+
+    # what was worked out about a listing before. saves downloading and checking it again.
+    def loadFeatures(self, newItem, listing, database):
+        minimumTimestamp = int(time.time()) - self.options['featureStoreDays'] * 24 * 60 * 60
+
+        row = database.getFirst('listingFeature', '*', 'siteName = ? and idInWebsite = ? and gmTimestamp >= ?', parameters=[newItem.get('siteName', ''), newItem.get('idInWebsite', ''), minimumTimestamp], flush=False)
+
+        if not row:
+            return
+
+        logging.debug(f'Using stored information about {listing["url"]}')
+
+        listing['text'] = row['text']
+        listing['email'] = row['email']
+
+        if row['pictureUrls'] is not None:
+            listing['pictureUrls'] = json.loads(row['pictureUrls'])
+
+        if row['labels']:
+            listing['labels'] = json.loads(row['labels'])
+
+        if row['textHash'] is not None:
+            listing['hashes']['text'] = row['textHash']
+
+        listing['storedFeatures'] = self.getFeatures(listing)
+
+    def saveFeatures(self, newItem, listing, database):
+        features = self.getFeatures(listing)
+
+        # nothing new was worked out
+        if features == listing['storedFeatures']:
+            return
+
+        if features['text'] is None and features['email'] is None and features['pictureUrls'] is None:
+            return
+
+        features['siteName'] = newItem.get('siteName', '')
+        features['idInWebsite'] = newItem.get('idInWebsite', '')
+        features['gmTimestamp'] = int(time.time())
+
+        database.insertLater('listingFeature', features)
+
+    def getFeatures(self, listing):
+        result = {
+            'text': listing['text'],
+            'email': listing['email'],
+            'pictureUrls': None,
+            'labels': json.dumps(listing['labels']),
+            'textHash': listing['hashes'].get('text')
+        }
+
+        if listing['pictureUrls'] is not None:
+            result['pictureUrls'] = json.dumps(listing['pictureUrls'])
+
+        return result
+
+    # an empty page means the download failed, for example because the request budget ran out
+    def loadListingPage(self, listing):
+        if listing['document'] is not None or listing['pageFailed']:
+            return
+
+        page = self.api.get(listing['url'], None, False)
+
+        if not page:
+            logging.error(f'Failed to get {listing["url"]}')
+            listing['pageFailed'] = True
+            return
+
+        listing['page'] = page
+        listing['document'] = lh.fromstring(page)
+
+    # the newest listing and the listings on the page the last time this city was fully checked
+    # a search for several rows can only stop where the last search of every one of them reached
+    def getWatermark(self, site, city, item, minimumPrice, maximumPrice, database):
+        result = {}
+
+        rows = []
+
+        for keyword, category in self.getRowKeys(item):
+            # a different price range gives different results
+            row = database.getFirst('crawlWatermark', '*', 'siteName = ? and city = ? and keyword = ? and category = ? and minimumPrice = ? and maximumPrice = ?', parameters=[helpers.getDomainName(site), city.get('url', ''), keyword, category, minimumPrice, maximumPrice], flush=False)
+
+            # this row needs the whole search
+            if not row:
+                return result
+
+            rows.append(row)
+
+        result = dict(rows[0])
+
+        # the same page is only known if every row saw it
+        if len(set(row['fingerprint'] for row in rows)) > 1:
+            result['fingerprint'] = ''
+
+        newestIds = [row['newestId'] or '' for row in rows]
+
+        result['newestId'] = ''
+
+        if all(id.isdigit() for id in newestIds):
+            result['newestId'] = str(min(int(id) for id in newestIds))
+
+        return result
+
+    # saved once the whole search is done
+    def addWatermark(self, site, city, item, minimumPrice, maximumPrice, fingerprint, newestId):
+        with self.lock:
+            for keyword, category in self.getRowKeys(item):
+                self.pendingWatermarks.append({
+                    'siteName': helpers.getDomainName(site),
+                    'city': city.get('url', ''),
+                    'keyword': keyword,
+                    'category': category,
+                    'minimumPrice': minimumPrice,
+                    'maximumPrice': maximumPrice,
+                    'fingerprint': fingerprint,
+                    'newestId': newestId,
+                    'gmTimestamp': int(time.time())
+                })
+
+    # without parsing the whole page
+    def getPageIds(self, page):
+        result = []
+
+        if not page:
+            return result
+
+        for link in re.findall(r'<a [^>]*class="result-title[^>]*>', page):
+            url = helpers.findBetween(link, 'href="', '"')
+
+            if url:
+                result.append(self.getId(url))
+
+        return result
+
+    def getFingerprint(self, ids):
+        if not ids:
+            return ''
+
+        return hashlib.sha1(' '.join(ids).encode('utf-8')).hexdigest()
+
+    def getNewestId(self, ids):
+        result = ''
+
+        numbers = [int(id) for id in ids if id.isdigit()]
+
+        if numbers:
+            result = str(max(numbers))
+
+        return result
+
+    # craigslist ids go up over time
+    def isOlder(self, id, newestId):
+        if not id.isdigit() or not newestId or not newestId.isdigit():
+            return False
+
+        return int(id) <= int(newestId)
+
+    # uses only what's on the search results page
+    def getPrefilterReason(self, item, newItem, minimumPrice, maximumPrice):
+        result = ''
+
+        price = newItem.get('price', 0)
+
+        # nearby results can be outside the range
+        if price < minimumPrice or price > maximumPrice:
+            result = 'price'
+            logging.info(f'Skipping. Price {price} is not between {minimumPrice} and {maximumPrice}.')
+            return result
+
+        # the title is part of the listing's text, so the listing would fail the word filters anyway
+        phrasesToAvoid = self.getPhraseMatcher(item.get('craigslist ad must not contain', ''))
+
+        phraseToAvoid = phrasesToAvoid.search(newItem.get('name', ''))
+
+        if phraseToAvoid:
+            result = 'title'
+            logging.info(f'Skipping. The title contains a phrase to avoid: {phraseToAvoid}')
+
+        return result
+
+    def countDrop(self, stage):
+        with self.lock:
+            self.dropCounts[stage] = self.dropCounts.get(stage, 0) + 1
+
+    def getDropSummary(self):
+        result = ''
+
+        names = {
+            'price': 'price outside the range',
+            'title': 'title has a phrase to avoid',
+            'words': 'listing text',
+            'picture': 'picture',
+            'repost': 'repost of a listing seen before',
+            'keyword': 'no keyword in the listing'
+        }
+
+        counts = []
+
+        for stage, count in self.dropCounts.items():
+            counts.append(f'{names.get(stage, stage)}: {count}')
+
+        if counts:
+            result = 'Skipped listings by reason. ' + ', '.join(counts) + '.'
+
+        return result
+
+    # pictures are downloaded and checked by their own pool of workers
+    def startPictureStage(self):
+        maximumPictureWorkers = self.options['maximumPictureWorkers']
+
+        self.pictureExecutor = None
+        self.pictureCheckExecutor = None
+        self.pictureFutures = []
+
+        if maximumPictureWorkers > 0:
+            self.pictureExecutor = ThreadPoolExecutor(max_workers=maximumPictureWorkers)
+
+        # for checking several pictures of the same listing at once
+        if self.options['picturesPerListing'] > 1:
+            self.pictureCheckExecutor = ThreadPoolExecutor(max_workers=max(1, self.options['maximumPictureDownloads']))
+
+        # search workers wait when this many pictures are waiting to be checked
+        self.picturesInFlight = threading.BoundedSemaphore(max(1, self.options['maximumPicturesInFlight']))
+
+        # limits per service
+        self.pictureDownloadLimit = threading.BoundedSemaphore(max(1, self.options['maximumPictureDownloads']))
+        self.labelDetectionLimit = threading.BoundedSemaphore(max(1, self.options['maximumLabelDetections']))
+
+    def submitPicture(self, site, item, newItem, listing, database, steps, start):
+        self.picturesInFlight.acquire()
+
+        try:
+            future = self.pictureExecutor.submit(self.runSteps, site, item, newItem, listing, database, steps, start, True)
+        except Exception as e:
+            self.picturesInFlight.release()
+            raise e
+
+        future.add_done_callback(self.onPictureDone)
+
+        with self.lock:
+            self.pictureFutures.append(future)
+
+    def onPictureDone(self, future):
+        self.picturesInFlight.release()
+
+        # so the search workers stop too
+        if future.exception():
+            self.shouldStop = True
+
+    def stopPictureStage(self):
+        if self.pictureExecutor:
+            self.pictureExecutor.shutdown(wait=True)
+            self.pictureExecutor = None
+
+        if self.pictureCheckExecutor:
+            self.pictureCheckExecutor.shutdown(wait=True)
+            self.pictureCheckExecutor = None
+
+        futures = self.pictureFutures
+        self.pictureFutures = []
+
+        for future in futures:
+            future.result()
+
+    # the page can come from a listing that was already downloaded
+    def getNewListing(self, loadedListing=None):
+        result = {
+            'page': None,
+            'document': None,
+            'url': '',
+            'wordsMatches': False,
+            'pictureMatches': True,
+            'pictureUrl': '',
+            'pictureUrls': None,
+            'email': None,
+            'text': None,
+            'labels': {},
+            'storedFeatures': None,
+            'hashes': {},
+            'duplicateOf': '',
+            'duplicateMatches': False,
+            'thingsInImage': [],
+            'pictureContains': '',
+            'pictureConfidence': '',
+            'pageFailed': False,
+            'cityUrl': ''
+        }
+
+        if loadedListing:
+            result['page'] = loadedListing['page']
+            result['document'] = loadedListing['document']
+            result['text'] = loadedListing['text']
+            result['pageFailed'] = loadedListing['pageFailed']
+            result['cityUrl'] = loadedListing['cityUrl']
+
+        return result
+
+    # the watermarks of this city aren't saved, so its listings are seen again next time
+    def leaveForNextTime(self, cityUrl):
+        with self.lock:
+            self.leftForNextTime.add(cityUrl)
+
+    # the request budget can run out before the maximum results are reached.
+    # item is an input row or a search that several rows share.
+    def isFinished(self, item):
+        result = self.shouldStop or self.enoughResults(item)
+
+        # the work that is left counts as refused, so the row is searched again next time
+        if not result and self.api.requestBudget.isExhausted():
+            self.api.requestBudget.refuse()
+            result = True
+
+        return result
+
+    # a shared search has enough when all of its rows do
+    def enoughResults(self, item):
+        maximum = self.options['maximumResultsPerKeyword']
+
+        if maximum < 0:
+            return False
+
+        keywords = [item.get('keyword', '')]
+
+        if 'targets' in item:
+            keywords = [target['item'].get('keyword', '') for target in item['targets']]
+
+        for keyword in keywords:
+            if self.resultCounts.get(keyword, 0) < maximum:
+                return False
+
+        return True
+
+    def reserveResult(self, item):
+        with self.lock:
+            if self.enoughResults(item):
+                return False
+
+            keyword = item.get('keyword', '')
+
+            self.resultCounts[keyword] = self.resultCounts.get(keyword, 0) + 1
+
+            return True
+
+    # the listing wasn't output after all
+    def releaseResult(self, item):
+        with self.lock:
+            keyword = item.get('keyword', '')
+
+            self.resultCounts[keyword] -= 1
+
+    def toDollars(self, s):
+        result = helpers.findBetween(s, '$', '.')
+
+        return int(result)
 
-            newItem['idInWebsite'] = self.getId(newItem['url'])
+    def needsPicture(self, item, listing):
+        self.loadPictureUrls(listing)
 
-            # avoid duplicates
-            if self.isInDatabase(site, newItem, database):
-                logging.info('Stopping. Already saw the subsequent results.')
-                break
+        if not listing['pictureUrl']:
+            return False
 
-            if newItem['price'] <= 0:
-                logging.info('Skipping price is less than or equal to zero')
-                continue
+        return bool(item.get('picture must contain one of', ''))
 
-            results.append(newItem)
+    # the first picture is shown in the report even when pictures aren't checked
+    def loadPictureUrls(self, listing):
+        if listing['pictureUrls'] is None:
+            self.loadListingPage(listing)
+            listing['pictureUrls'] = self.getPictureUrls(listing)
 
-            price = newItem['price']
-            name = newItem['name']
+        if listing['pictureUrls'] and not listing['pictureUrl']:
+            listing['pictureUrl'] = listing['pictureUrls'][0]
 
-            logging.info(f'Results: {len(results)}. Name: {name}. Price: {price}.')
+    def getPictureUrls(self, listing):
+        result = []
 
-        return results
-    
-    def search(self, onItemIndex, site, item, database, averageSellingPrice):
-        if not averageSellingPrice:
-            return
+        if listing['pageFailed']:
+            return result
 
-        self.hasNotifiedForThisSearch = False
+        for picture in listing['document'].xpath("//a[@class = 'thumb']"):
+            url = picture.attrib.get('href', '')
 
-        self.api.proxies = self.internet.getRandomProxy()
+            if url and not url in result:
+                result.append(url)
 
-        self.averageSellingPrice = averageSellingPrice
-        
-        i = 0
+        imageList = helpers.findBetween(listing['page'], 'var imgList = ', ';\n', True)
 
-        keyword = item.get('keyword', '')
+        if imageList:
+            imageList = json.loads(imageList)
 
-        keywords = urllib.parse.quote_plus(keyword)
-        
-        minimumPrice = item.get('min price', '')
-        minimumPrice = int(minimumPrice)
+            for image in imageList:
+                url = image.get('url', '')
 
-        # don't want items that cost more than the selling price
-        # sss means all for sale
-        category = item.get('craigslist category', 'sss')
+                if url and not url in result:
+                    result.append(url)
 
-        minimumProfit = item.get('min profit', 10)
-        minimumProfit = int(minimumProfit)
+        return result
 
-        shipping = item.get('shipping cost', 0)
-        shipping = float(shipping)
+    # the first picture is sometimes a box or a receipt. checks several at once and stops at the first match.
+    def picturePassesFilters(self, item, listing):
+        result = False
 
-        priceWant = self.averageSellingPrice - minimumProfit - shipping
-        priceWant = int(round(priceWant))
+        if not self.needsPicture(item, listing):
+            return True
 
-        maximumPrice = priceWant
+        urls = listing['pictureUrls'][0:max(1, self.options['picturesPerListing'])]
 
-        if priceWant < minimumPrice:
-            minimumPrice = 1
+        # pictures checked before cost nothing, so they go first
+        known = [url for url in urls if url in listing['labels']]
+        unknown = [url for url in urls if not url in listing['labels']]
 
-        resultCount = 0
+        pictures = self.checkPicturesInOrder(item, known, listing['labels'])
 
-        for city in self.siteInformation['cities']:
-            if self.options['maximumResultsPerKeyword'] > -1 and resultCount >= self.options['maximumResultsPerKeyword']:
-                logging.info(f'Stopping. Reached maximum of {resultCount} results.')
-                break
+        if not any(picture['matches'] for picture in pictures):
+            if len(unknown) <= 1 or not self.pictureCheckExecutor:
+                pictures += self.checkPicturesInOrder(item, unknown, listing['labels'])
+            else:
+                pictures += self.checkPictures(item, unknown, listing['labels'])
 
-            if '--debug' in sys.argv and city.get('url', '') == 'https://albuquerque.craigslist.org':
-                logging.info('Stopping')
-                break
+        downloaded = [picture for picture in pictures if picture['downloaded']]
 
-            cityName = city.get('name', '')
+        for picture in downloaded:
+            listing['labels'][picture['url']] = picture['thingsInImage']
 
-            logging.info(f'Keyword {onItemIndex}: {keyword}. Site: craigslist. City {i + 1}: {cityName}. Price: {minimumPrice} to {maximumPrice}.')
-            i += 1
+        if not downloaded:
+            logging.error(f'Failed to download {listing["pictureUrl"]}')
+            return False
 
-            urlToGet = city.get('url', '')
-            urlToGet += f'/search/{category}?query={keywords}&sort=rel&min_price={minimumPrice}&max_price={maximumPrice}'
+        listing['thingsInImage'] = downloaded[0]['thingsInImage']
 
-            page = self.api.get(urlToGet, None, False)
-            items = self.getResults(site, item, page, database)
+        for picture in downloaded:
+            if not picture['matches']:
+                continue
 
-            for newItem in items:
-                wordMatches = self.passesWordFilters(item, newItem)
-                pictureMatches = False
-                
-                # no point looking these up if words don't match
-                if wordMatches:
-                    self.email = self.getEmail(newItem, self.document)                    
-                    pictureMatches = self.picturePassesFilters(item, self.document)                     
-
-                jsonColumn = {
-                    'email': self.email,
-                    'picture': self.pictureUrl,
-                    'picture similarity': '',
-                    'things in image': self.thingsInImage
-                }
+            listing['pictureUrl'] = picture['url']
+            listing['thingsInImage'] = picture['thingsInImage']
+            listing['pictureContains'] = picture['pictureContains']
+            listing['pictureConfidence'] = picture['pictureConfidence']
 
-                matches = wordMatches and pictureMatches
+            result = True
+            break
 
-                newItem['matches'] = int(matches)
-                newItem['json'] = jsonColumn
+        if not result:
+            logging.info(f'Skipping. The picture doesn\'t contain any the specified things.')
 
-                # only output to csv/html files if words match
-                if wordMatches and (pictureMatches or self.options['onlyOutputPictureMatches'] == 0):
-                    self.outputResult(site, item, newItem)
+        return result
 
-                    url = newItem.get('url', '')
-                    name = newItem.get('name', '')
-                    price = newItem.get('price', '')
+    def checkPicturesInOrder(self, item, urls, knownLabels):
+        result = []
 
-                    self.notify('New result', f'Link: {url}\nKeyword: {keyword}\nTitle: {name}\nPrice: ${price}\n\nCheck the output directory for details.')
+        for url in urls:
+            picture = self.checkPicture(item, url, None, knownLabels)
+            result.append(picture)
 
-                    resultCount += 1
+            if picture['matches']:
+                break
 
-                newItem['json'] = json.dumps(newItem['json'])
+        return result
 
-                # store to database so can skip it next time
-                database.insert('result', newItem)     
+    def checkPictures(self, item, urls, knownLabels):
+        result = []
 
-            self.waitBetween()
+        found = threading.Event()
 
-    def toDollars(self, s):
-        result = helpers.findBetween(s, '$', '.')
+        futures = [self.pictureCheckExecutor.submit(self.checkPicture, item, url, found, knownLabels) for url in urls]
 
-        return int(result)
+        for future in as_completed(futures):
+            picture = future.result()
+            result.append(picture)
 
-    def picturePassesFilters(self, item, document):
-        result = False
+            if not picture['matches']:
+                continue
 
-        pictures = document.xpath("//a[@class = 'thumb']")
+            found.set()
 
-        if pictures:
-            self.pictureUrl = pictures[0].attrib['href']
+            # the others aren't needed now
+            for other in futures:
+                other.cancel()
 
-        if not self.pictureUrl:
-            imageList = helpers.findBetween(self.page, 'var imgList = ', ';\n', True)
+            break
 
-            if imageList:
-                imageList = json.loads(imageList)
+        return result
 
-                if imageList:
-                    self.pictureUrl = imageList[0].get('url', '')
+    def checkPicture(self, item, url, found, knownLabels):
+        result = {
+            'url': url,
+            'downloaded': False,
+            'thingsInImage': [],
+            'pictureContains': '',
+            'pictureConfidence': '',
+            'matches': False
+        }
 
-        if not self.pictureUrl:
-            return True
+        if found and found.is_set():
+            return result
 
-        thingsToFind = item.get('picture must contain one of', '')
+        # checked before
+        if url in knownLabels:
+            result['downloaded'] = True
+            result['thingsInImage'] = knownLabels[url]
+            self.findThingsInPicture(item, result)
+            return result
 
-        if not thingsToFind:
-            return True
+        with self.pictureDownloadLimit:
+            imageBytes = self.getPicture(url)
 
-        pictureFileName = 'user-data/logs/cache/picture'
+        if not imageBytes:
+            return result
 
-        if os.path.exists(pictureFileName):
-            os.remove(pictureFileName)
-        
-        helpers.makeDirectory(os.path.dirname(pictureFileName))
+        result['downloaded'] = True
 
-        response = self.api.get(self.pictureUrl, None, False, True)
+        # another picture already matched
+        if found and found.is_set():
+            return result
 
-        helpers.toBinaryFile(response.content, pictureFileName)
+        with self.labelDetectionLimit:
+            result['thingsInImage'] = self.aws.detectLabels(imageBytes)
 
-        if os.stat(pictureFileName).st_size == 0:
-            logging.error(f'Failed to download {self.pictureUrl}')
-            return False
-        
-        self.thingsInImage = self.aws.detect_labels_local_file(pictureFileName)
+        self.findThingsInPicture(item, result)
+
+        return result
+
+    def findThingsInPicture(self, item, picture):
+        thingsToFind = item.get('picture must contain one of', '')
 
         minimumConfidence = item.get('picture confidence %', '')
 
@@ -334,7 +1702,7 @@ class Craigslist:
         # show labels
         toLog = []
         
-        for thing in self.thingsInImage:
+        for thing in picture['thingsInImage']:
             name = thing.get('Name', '').lower()
             confidence = thing.get('Confidence', 0)
             confidence = helpers.fixedDecimals(confidence, 0)
@@ -344,7 +1712,7 @@ class Craigslist:
         toLog = ', '.join(toLog)
         logging.info('In picture: ' + toLog)
 
-        for thing in self.thingsInImage:
+        for thing in picture['thingsInImage']:
             name = thing.get('Name', '').lower()
             confidence = thing.get('Confidence', 0)
 
@@ -352,7 +1720,7 @@ class Craigslist:
             
             for toFind in thingsToFind.split(';'):
                 if toFind.lower().strip() == name:
-                    self.pictureContains = toFind
+                    picture['pictureContains'] = toFind
                     nameMatches = True
                     break
 
@@ -362,24 +1730,52 @@ class Craigslist:
             if confidence < minimumConfidence:
                 continue
 
-            self.pictureConfidence = helpers.fixedDecimals(confidence, 0)
-            
-            result = True
+            picture['pictureConfidence'] = helpers.fixedDecimals(confidence, 0)
+            picture['matches'] = True
 
-            logging.info(f'The picture contains {name}. Confidence: {self.pictureConfidence}%. Considering it a match.')
+            logging.info(f'The picture contains {name}. Confidence: {picture["pictureConfidence"]}%. Considering it a match.')
             break
 
-        if not result:
-            logging.info(f'Skipping. The picture doesn\'t contain any the specified things.')
+        if not picture['matches']:
+            picture['pictureContains'] = ''
+    
+    # the smaller version is enough to find things in the picture
+    def getPicture(self, url):
+        maximumBytes = self.options['maximumPictureKilobytes'] * 1000
+
+        smallUrl = self.getSmallPictureUrl(url)
+
+        result = self.api.getBinary(smallUrl, maximumBytes)
+
+        if not result and smallUrl != url:
+            result = self.api.getBinary(url, maximumBytes)
 
         return result
-    
+
+    # picture urls end in the size. for example _600x450.jpg.
+    def getSmallPictureUrl(self, url):
+        result = url
+
+        size = self.options['pictureSize']
+
+        if not size:
+            return result
+
+        result = re.sub(r'_\d+x\d+c?(\.\w+)$', f'_{size}\\1', url)
+
+        return result
+
     def isInDatabase(self, site, newItem, database):
         result = False
 
         siteName = helpers.getDomainName(site)
         idInWebsite = newItem.get('idInWebsite', '')
-        existingItem = database.getFirst('result', '*', f"siteName= '{siteName}' and idInWebsite = '{idInWebsite}'", '', '')
+
+        # definitely new. no need to ask the database.
+        if not idInWebsite in self.getSeenIndex(siteName, database):
+            return result
+
+        existingItem = database.getFirst('result', 'idInWebsite', 'siteName = ? and idInWebsite = ?', parameters=[siteName, idInWebsite])
 
         if existingItem:
             logging.info(f'Skipping. {siteName} ID {idInWebsite} is already in the database.')
@@ -387,51 +1783,64 @@ class Craigslist:
 
         return result
 
-    def containsCaseInsensitive(self, listOfPhrases, s):
-        result = None
+    def getSeenIndex(self, siteName, database):
+        seenIndex = self.seenIndexes.get(siteName)
 
-        if not listOfPhrases:
-            return result
-        
-        s = s.lower()
+        if seenIndex and not seenIndex.isFull():
+            return seenIndex
 
-        for item in listOfPhrases:
-            if item.lower() in s:
-                result = item
-                break
+        with self.lock:
+            seenIndex = self.seenIndexes.get(siteName)
+
+            if seenIndex and not seenIndex.isFull():
+                return seenIndex
+
+            row = database.getFirst('result', 'count(*) as count', 'siteName = ?', parameters=[siteName])
+            count = helpers.get(row, 'count')
+
+            logging.debug(f'Loading {count} {siteName} IDs into the seen index')
+
+            # room to grow before it needs rebuilding
+            seenIndex = BloomFilter(max(100000, count * 2))
+
+            for row in database.iterate('select idInWebsite from result where siteName = ?', [siteName]):
+                seenIndex.add(row['idInWebsite'])
+
+            self.seenIndexes[siteName] = seenIndex
+
+        return seenIndex
+
+    def addToSeenIndex(self, site, newItem, database):
+        seenIndex = self.getSeenIndex(helpers.getDomainName(site), database)
+
+        with self.lock:
+            seenIndex.add(newItem.get('idInWebsite', ''))
+
+    # each input row's phrases are only prepared once
+    def getPhraseMatcher(self, string):
+        result = self.phraseMatchers.get(string)
+
+        if result is None:
+            result = PhraseMatcher(string)
+            self.phraseMatchers[string] = result
 
         return result
 
-    def passesWordFilters(self, searchItem, resultItem):
+    def passesWordFilters(self, searchItem, resultItem, listing):
         result = False
 
-        self.pictureUrl = ''
-        self.email = ''
-        self.page = None
-        self.document = None
-        self.thingsInImage = []
-        self.pictureContains = ''
-        self.pictureConfidence = ''
+        phrasesToFindString = searchItem.get('craigslist ad must contain', '')
+        phrasesToAvoidString = searchItem.get('craigslist ad must not contain', '')
 
-        phrasesToFind = searchItem.get('craigslist ad must contain', '')
-        phrasesToAvoid = searchItem.get('craigslist ad must not contain', '')
+        phrasesToFind = self.getPhraseMatcher(phrasesToFindString)
+        phrasesToAvoid = self.getPhraseMatcher(phrasesToAvoidString)
 
         if not phrasesToFind and not phrasesToAvoid:
             return True
 
         url = resultItem.get('url', '')
         
-        logging.info(f'Seeing if {url} contains at least one of "{phrasesToFind}" and none of "{phrasesToAvoid}"')
-
-        if phrasesToFind:
-            phrasesToFind = phrasesToFind.split(';')
-        else:
-            phrasesToFind = []
-
-        if phrasesToAvoid:
-            phrasesToAvoid = phrasesToAvoid.split(';')
-        else:
-            phrasesToAvoid = []
+        logging.info(f'Seeing if {url} contains at least one of "{phrasesToFindString}" and none of "{phrasesToAvoidString}"')
 
         containsPhraseToFind = False
         containsPhraseToAvoid = False
@@ -439,31 +1848,22 @@ class Craigslist:
         if not phrasesToFind:
             containsPhraseToFind = True
 
-        if not phrasesToAvoid:
-            containsPhraseToAvoid = False
-
-        page = self.api.get(url, None, False)
-        self.page = page
-        document = lh.fromstring(page)
-        self.document = document
+        if listing['text'] is None:
+            listing['text'] = self.getListingText(listing)
 
-        elements = document.xpath("//body")
+        page = listing['text']
 
-        if elements:
-            # get plain text
-            for element in elements[0].findall(".//script"):
-                element.getparent().remove(element)
-            
-            page = elements[0].text_content()
+        # fold once for both lists
+        page = phrasesToFind.fold(page)
 
-        phraseToFind = self.containsCaseInsensitive(phrasesToFind, page)
-        phraseToAvoid = self.containsCaseInsensitive(phrasesToAvoid, page)
+        phraseToFind = phrasesToFind.searchFolded(page)
+        phraseToAvoid = phrasesToAvoid.searchFolded(page)
 
         if phraseToFind:
             logging.info(f'It contains a specified phrase: {phraseToFind}')
             containsPhraseToFind = True
         elif phrasesToFind:
-            logging.info(f'Skipping. It does not contain at least one of: {phrasesToFind}.')
+            logging.info(f'Skipping. It does not contain at least one of: {phrasesToFind.phrases}.')
 
         if phraseToAvoid:
             logging.info(f'Skipping. It contains a phrase to avoid: {phraseToAvoid}')
@@ -475,6 +1875,28 @@ class Craigslist:
         
         return result
 
+    def getListingText(self, listing):
+        result = ''
+
+        self.loadListingPage(listing)
+
+        if listing['pageFailed']:
+            return result
+
+        result = listing['page']
+        document = listing['document']
+
+        elements = document.xpath("//body")
+
+        if elements:
+            # get plain text
+            for element in elements[0].findall(".//script"):
+                element.getparent().remove(element)
+            
+            result = elements[0].text_content()
+
+        return result
+
     def getEmail(self, newItem, document):
         url = newItem.get('url', '')
         
@@ -497,33 +1919,12 @@ class Craigslist:
 
         return string
 
-    def outputResult(self, site, searchItem, newItem):
-        helpers.makeDirectory(self.options['outputDirectory'])
-
-        fileName = datetime.datetime.now().strftime('%Y.%m.%d') + ' ' + helpers.lettersNumbersAndSpacesOnly(searchItem.get('keyword', '')) + '.csv'
-        fileName = os.path.join(self.options['outputDirectory'], fileName)
-
-        # write headers
-        if not os.path.exists(fileName):
-            headers = ['date', 'keyword', 'craigslist category', 'matches']
-
-            for site in self.options['sites']:
-                siteName = helpers.getDomainName(site)
-
-                headers.append(siteName + ' price')
-
-            headers.append('profit')
-            headers.append('picture contains')
-            headers.append('picture confidence %')
-            headers.append('url')
-            headers.append('email')
-            headers.append('picture')
-
-            line = ','.join(headers)
-
-            helpers.toFile(line, fileName)
-            helpers.toFile(line, fileName + '-backup.csv')
+    def outputResult(self, site, searchItem, newItem, listing):
+        # workers share the output files
+        with self.lock:
+            self.writeResult(site, searchItem, newItem, listing)
 
+    def writeResult(self, site, searchItem, newItem, listing):
         keyword = searchItem.get('keyword', '')
 
         now = datetime.datetime.utcnow()
@@ -534,119 +1935,93 @@ class Craigslist:
 
         fields.append(str(newItem.get('matches', '')))
 
-        fields.append(str(self.averageSellingPrice))
+        averageSellingPrice = self.averageSellingPrices.get(self.planner.normalize(keyword), '')
+
+        fields.append(str(averageSellingPrice))
         fields.append(str(newItem.get('price', '')))
 
-        revenue = self.averageSellingPrice 
-        costs = newItem.get('price', '') + float(searchItem.get('shipping cost', 0))
-        
-        profit = revenue - costs
-        profit = int(round(profit))
+        profit = self.getProfit(searchItem, newItem)
         
         fields.append(str(profit))
         
-        fields.append(self.pictureContains)
-        fields.append(self.pictureConfidence)
+        fields.append(listing['pictureContains'])
+        fields.append(listing['pictureConfidence'])
         
         fields.append(newItem.get('url', ''))
         
         fields.append(helpers.getNested(newItem, ['json', 'email']))
         fields.append(helpers.getNested(newItem, ['json', 'picture']))
 
-        line = ','.join(fields)
-    
-        helpers.appendToFile(line, fileName)
-        helpers.appendToFile(line, fileName + '-backup.csv')
-
-        self.csvToHtml(searchItem, fileName)
+        self.getReport(searchItem).add(fields)
 
-    def csvToHtml(self, searchItem, fileName):
-        csv = helpers.getCsvFile(fileName)
-
-        file = helpers.getFile('program/resources/template.html')
+    # what each keyword found, for the request budget
+    def addValue(self, item, profit):
+        with self.lock:
+            value = self.values.setdefault(self.planner.normalize(item.get('keyword', '')), {
+                'results': 0,
+                'profit': 0
+            })
 
-        table = '<table>\n'
-        table += '    <thead>\n'
+            value['results'] += 1
+            value['profit'] += profit
 
-        isFirstRow = True
+    def getValues(self):
+        with self.lock:
+            result = self.values
+            self.values = {}
 
-        for row in csv:
-            if not row.get('picture', ''):
-                continue
+        return result
 
-            table += f'        <tr>\n'
+    def getProfit(self, searchItem, newItem):
+        revenue = self.averageSellingPrices.get(self.planner.normalize(searchItem.get('keyword', '')), 0)
+        costs = newItem.get('price', '') + float(searchItem.get('shipping cost', 0))
+        
+        profit = revenue - costs
+        profit = int(round(profit))
 
-            if isFirstRow:
-                tag = 'th'
+        return profit
 
-                for column in row:
-                    table += f'            <{tag}>{column}</{tag}>\n'
+    def getReport(self, searchItem):
+        helpers.makeDirectory(self.options['outputDirectory'])
 
-                isFirstRow = False
-                
-                table += '        </tr>\n'
-                table += '    </thead>\n'
-                table += '    <tbody>\n'
-                table += '        <tr>\n'
-            
-            for column in row:
-
-                if column == 'url':
-                    row[column] = f'<a href="{row[column]}" target="_blank">{row[column]}</a>'
-                elif column == 'email':
-                    shortUrl = helpers.findBetween(row[column], 'mailto:', '?')
-                    
-                    row[column] = f'''
-                    <p>
-                        <a href="{row[column]}">{shortUrl}</a>
-                    </p>
-                    <p>
-                        <button id="1" type="button" class="btn btn-outline-secondary choose-item unselected" data-email="{shortUrl}">Select</button>
-                    </p>
-                    '''
-                elif column == 'picture':
-                    row[column] = f'<a href="{row[column]}" target="_blank"><img src="{row[column]}"/></a>'
-                else:
-                    row[column] = html.escape(row[column], quote=False)
+        fileName = datetime.datetime.now().strftime('%Y.%m.%d') + ' ' + helpers.lettersNumbersAndSpacesOnly(searchItem.get('keyword', '')) + '.csv'
+        fileName = os.path.join(self.options['outputDirectory'], fileName)
 
-                tag = 'td'
-                
-                table += f'            <{tag}>{row[column]}</{tag}>\n'
+        if fileName in self.reports:
+            return self.reports[fileName]
 
-            table += '        </tr>\n'
+        headers = ['date', 'keyword', 'craigslist category', 'matches']
 
-        table += '    </tbody>\n'
-        table += '</table>'
+        for site in self.options['sites']:
+            siteName = helpers.getDomainName(site)
 
-        emailBodyFile = 'user-data/input/' + searchItem.get('email body', 'email.html')
-        emailSubjectFile = 'user-data/input/' + searchItem.get('email subject', 'subject.txt')
+            headers.append(siteName + ' price')
 
-        emailVariables = {
-            'keyword': searchItem.get('keyword', '')
-        }
+        headers.append('profit')
+        headers.append('picture contains')
+        headers.append('picture confidence %')
+        headers.append('url')
+        headers.append('email')
+        headers.append('picture')
 
-        message = helpers.getFile(emailBodyFile)
-        message = helpers.replaceVariables(message, emailVariables, '$')
+        result = Report(self.options, searchItem, fileName, headers)
 
-        subject = helpers.getFile(emailSubjectFile)
-        subject = helpers.replaceVariables(subject, emailVariables, '$')
+        self.reports[fileName] = result
 
-        variables = {
-            'table': table,
-            'subject': subject,
-            'message': message,
-            'subjectEscaped': html.escape(subject),
-            'messageEscaped': html.escape(message)
-        }
+        return result
 
-        file = helpers.replaceVariables(file, variables, '%')
+    def closeReports(self):
+        with self.lock:
+            for report in self.reports.values():
+                report.close()
 
-        # Save to file
-        htmlFileName = helpers.fileNameOnly(fileName, False) + '.html'
-        htmlFileName = self.options['outputDirectory'] + '/' + htmlFileName
-        helpers.toFile(file, htmlFileName)
+            self.reports = {}
 
     def notify(self, subject, message):
+        with self.lock:
+            self.notifyOnce(subject, message)
+
+    def notifyOnce(self, subject, message):
         if self.notificationCount >= self.options['maximumNotificationEmailsPerDay']:
             return
 
@@ -674,16 +2049,6 @@ class Craigslist:
 
         self.notificationCount += 1
 
-    def waitBetween(self):
-        secondsBetweenItems = self.options['secondsBetweenItems']
-
-        if '--debug' in sys.argv:
-            secondsBetweenItems = 3
-
-        logging.info(f'Waiting {secondsBetweenItems} seconds')
-
-        time.sleep(secondsBetweenItems)
-
     def getId(self, url):
         result = ''
 
@@ -695,23 +2060,41 @@ class Craigslist:
         result = fields[-1]
         return helpers.findBetween(result, '', '.')
 
-    def __init__(self, options, emailer):
-        self.averageSellingPrice = None
+    # aws can be replaced, for example by a detector that returns fixed labels
+    def __init__(self, options, emailer, aws=None):
+        self.averageSellingPrices = {}
         self.notificationCount = 0
         self.hasNotifiedForThisSearch = False
-        self.pictureUrl = ''
-        self.email = ''
-        self.page = None
-        self.document = None
+        self.resultCounts = {}
+        self.shouldStop = False
+        self.lock = threading.RLock()
+        self.seenIndexes = {}
+        self.reports = {}
         self.emailer = emailer
+        self.pictureExecutor = None
+        self.pictureCheckExecutor = None
+        self.pictureFutures = []
+        self.phraseMatchers = {}
+        self.dropCounts = {}
+        self.stepStatistics = {}
+        self.nearDuplicates = None
+        self.leftForNextTime = set()
+        self.pendingWatermarks = []
+        self.pendingPriceBands = []
+        self.planner = QueryPlanner(options)
+        self.cityScheduler = None
+        self.values = {}
+
+        # craigslist shows this many listings per page
+        self.resultsPerPage = 120
 
         self.siteInformation = json.loads(helpers.getFile('craigslist.json'))
 
-        self.api = Api('')
-        
         self.options = options
 
-        self.aws = Aws(self.options)
+        self.api = Api('', self.options)
+
+        self.aws = aws or Aws(self.options)
 
         self.internet = Internet(self.options)
 
@@ -719,10 +2102,18 @@ class Marketplaces:
     def run(self):
         self.initialize()
 
-        for row in helpers.getCsvFile(self.options['inputFile']):
+        rows = helpers.getCsvFile(self.options['inputFile'])
+
+        self.budgetAllocator.start([(site, row) for row in rows for site in self.options['sites']])
+
+        for row in rows:
             self.showStatus(row)
             self.doItem(row)
 
+        self.searchPlan()
+
+        self.budgetAllocator.save()
+
         self.cleanUp()
 
     def doItem(self, item):
@@ -735,23 +2126,41 @@ class Marketplaces:
             i += 1
 
             if self.isDone(site, item):
+                self.budgetAllocator.removeJob(site, item)
                 continue
 
+            isPlanned = self.isPlanned(site)
+
+            # planned searches get their budget when they run
+            if not isPlanned:
+                self.budgetAllocator.startJob([(site, item)])
+
             try:
                 self.lookUpItem(site, item)
 
                 if not self.averageSellingPrice:
                     logging.error(f'Skipping. Did not find average selling price.')
+                    self.budgetAllocator.removeJob(site, item)
                     continue
 
-                self.markDone(site, item)
+                # done once the combined searches have run
+                if isPlanned:
+                    self.plannedItems.append((site, item))
+                    continue
 
-                if site == 'craigslist':
-                    self.waitBetween()
+                # try again next time
+                if self.craigslist.api.requestBudget.wasRefused():
+                    continue
+
+                self.markDone(site, item)
             except Exception as e:
                 logging.error(f'Skipping. Something went wrong.')
                 logging.error(e)
                 logging.debug(traceback.format_exc())
+                self.budgetAllocator.removeJob(site, item)
+            finally:
+                if not isPlanned:
+                    self.budgetAllocator.stopJob(self.craigslist.getValues())
 
     def lookUpItem(self, site, item):
         if 'checkaflip' in site:
@@ -761,7 +2170,50 @@ class Marketplaces:
         elif 'craigslist' in site:
             self.getAverageSellingPrice(item)
 
-            self.craigslist.search(self.onItemIndex, site, item, self.database, self.averageSellingPrice)
+            if self.isPlanned(site):
+                self.craigslist.addToPlan(site, item, self.averageSellingPrice)
+            else:
+                self.craigslist.search(self.onItemIndex, site, item, self.database, self.averageSellingPrice)
+
+    def isPlanned(self, site):
+        return 'craigslist' in site and self.options['mergeSearches'] == 1
+
+    # all the input rows at once, so rows that can share a search only need one
+    def searchPlan(self):
+        if not self.plannedItems:
+            return
+
+        queries = self.craigslist.getPlan()
+
+        try:
+            for i, query in enumerate(queries):
+                self.searchPlannedQuery(i + 1, query)
+        finally:
+            self.craigslist.finishPlan(queries)
+
+        self.plannedItems = []
+
+    # a failure only affects the rows that share that search
+    def searchPlannedQuery(self, index, query):
+        jobs = [(target['site'], target['item']) for target in query['targets']]
+
+        self.budgetAllocator.startJob(jobs)
+
+        try:
+            self.craigslist.searchQuery(index, query['site'], query, self.database)
+
+            # try again next time
+            if self.craigslist.api.requestBudget.wasRefused():
+                return
+
+            for site, item in jobs:
+                self.markDone(site, item)
+        except Exception as e:
+            logging.error(f'Skipping. Something went wrong.')
+            logging.error(e)
+            logging.debug(traceback.format_exc())
+        finally:
+            self.budgetAllocator.stopJob(self.craigslist.getValues())
 
     def showStatus(self, row):
         keyword = row.get('keyword', '')
@@ -779,9 +2231,9 @@ class Marketplaces:
         keyword = item.get('keyword', '')
         hours = item.get('hours between runs', '')
 
-        minimumDate = helpers.getDateStringSecondsAgo(int(hours) * 60 * 60, True)
+        minimumTimestamp = int(time.time()) - int(hours) * 60 * 60
 
-        row = self.database.getFirst('result', 'price', f"siteName= 'checkaflip.com' and keyword = '{keyword}' and gmDate >= '{minimumDate}'", '', '')
+        row = self.database.getFirst('result', 'price', 'siteName = ? and keyword = ? and gmTimestamp >= ?', parameters=['checkaflip.com', keyword, minimumTimestamp])
 
         self.averageSellingPrice = row.get('price', '')
 
@@ -796,9 +2248,9 @@ class Marketplaces:
             logging.error('Hours between runs is blank for this line')
             return result
 
-        minimumDate = helpers.getDateStringSecondsAgo(int(hours) * 60 * 60, True)
+        minimumTimestamp = int(time.time()) - int(hours) * 60 * 60
 
-        gmDateLastCompleted = self.database.getFirst('jobHistory', '*', f"siteName= '{siteName}' and keyword = '{keyword}' and gmDateLastCompleted >= '{minimumDate}'", '', '')
+        gmDateLastCompleted = self.database.getFirst('jobHistory', '*', 'siteName = ? and keyword = ? and gmTimestampLastCompleted >= ?', parameters=[siteName, keyword, minimumTimestamp])
 
         if gmDateLastCompleted:
             logging.info(f'Skipping. Too soon since last completed this job.')
@@ -812,7 +2264,8 @@ class Marketplaces:
         item = {
             'siteName': siteName,
             'keyword': item.get('keyword', ''),
-            'gmDateLastCompleted': str(datetime.datetime.utcnow())
+            'gmDateLastCompleted': str(datetime.datetime.utcnow()),
+            'gmTimestampLastCompleted': int(time.time())
         }
 
         logging.info(f'Inserting into database')
@@ -823,25 +2276,25 @@ class Marketplaces:
     def removeOldItems(self):
         maximumDaysToKeepItems = self.options['maximumDaysToKeepItems']
         
-        minimumDate = helpers.getDateStringSecondsAgo(maximumDaysToKeepItems * 24 * 60 * 60, False)
+        minimumTimestamp = int(time.time()) - maximumDaysToKeepItems * 24 * 60 * 60
         
         logging.debug(f'Deleting items older than {maximumDaysToKeepItems} days')
-        self.executeDatabaseStatement(f"delete from result where gmDate < '{minimumDate}'")
+        self.executeDatabaseStatement(f"delete from result where gmTimestamp < {minimumTimestamp}")
+        self.executeDatabaseStatement(f"delete from nearDuplicate where gmTimestamp < {minimumTimestamp}")
+        self.executeDatabaseStatement(f"delete from nearDuplicateBand where gmTimestamp < {minimumTimestamp}")
+        self.executeDatabaseStatement(f"delete from crawlWatermark where gmTimestamp < {minimumTimestamp}")
+        self.executeDatabaseStatement(f"delete from priceBand where gmTimestamp < {minimumTimestamp}")
+        self.executeDatabaseStatement(f"delete from cityYield where gmTimestamp < {minimumTimestamp}")
+        self.executeDatabaseStatement(f"delete from budgetHistory where gmTimestamp < {minimumTimestamp}")
 
-    def waitBetween(self):
-        secondsBetweenItems = self.options['secondsBetweenItems']
+        minimumTimestamp = int(time.time()) - self.options['featureStoreDays'] * 24 * 60 * 60
 
-        if '--debug' in sys.argv:
-            secondsBetweenItems = 3
-    
-        logging.info(f'Waiting {secondsBetweenItems} seconds')
-
-        time.sleep(secondsBetweenItems)
+        self.executeDatabaseStatement(f"delete from listingFeature where gmTimestamp < {minimumTimestamp}")
 
     def executeDatabaseStatement(self, statement):
         try:
-            c = self.database.cursor
-            c.execute(statement)
+            with self.database.transaction():
+                self.database.cursor.execute(statement)
         except Exception as e:
             logging.error('Database error:')
             logging.error(e)
@@ -850,6 +2303,9 @@ class Marketplaces:
     def cleanUp(self):
         self.database.close()
 
+        self.craigslist.api.close()
+        self.craigslist.aws.close()
+
         logging.info('Done')
 
     def initialize(self):
@@ -858,11 +2314,7 @@ class Marketplaces:
         logging.info('Starting\n')
 
         self.onItemIndex = 0
-
-        self.database = Database('database.sqlite')
-
-        self.executeDatabaseStatement('create table if not exists result ( siteName text, idInWebsite text, keyword text, gmDate text, url text, name text, price integer, matches integer, json text, primary key(siteName, idInWebsite) )')
-        self.executeDatabaseStatement('create table if not exists jobHistory ( siteName text, keyword text, gmDateLastCompleted text, primary key(siteName, keyword) )')
+        self.plannedItems = []
 
         self.options = {
             'inputFile': 'input.csv',
@@ -881,16 +2333,62 @@ class Marketplaces:
             'awsResourceUrl': helpers.getFile('program/resources/resource'),
             'sendGridResourceUrl': helpers.getFile('program/resources/resource3'),
             'maximumNotificationEmailsPerDay': 1,
-            'maximumResultsPerKeyword': -1
+            'maximumResultsPerKeyword': -1,
+            'maximumWorkers': 1,
+            'requestsPerMinutePerHost': 60,
+            'requestsPerMinutePerDomain': 180,
+            'requestsPerMinutePerProxy': 120,
+            'requestBurst': 5,
+            'slowResponseSeconds': 10,
+            'maximumRetryAfterSeconds': 600,
+            'maximumSessions': 50,
+            'connectionsPerSession': 10,
+            'sessionIdleSeconds': 60,
+            'cacheRules': '',
+            'maximumCacheMegabytes': 500,
+            'databaseBatchSize': 100,
+            'databaseFlushSeconds': 10,
+            'databasePragmas': '',
+            'labelCacheDays': 30,
+            'maximumLabelCacheEntries': 100000,
+            'pictureSize': '300x300',
+            'maximumPictureKilobytes': 500,
+            'maximumPictureDimension': 800,
+            'maximumPictureWorkers': 8,
+            'maximumPicturesInFlight': 32,
+            'maximumPictureDownloads': 8,
+            'maximumLabelDetections': 4,
+            'picturesPerListing': 1,
+            'featureStoreDays': 7,
+            'incrementalCrawl': 1,
+            'maximumPagesPerCity': 5,
+            'maximumPriceBands': 16,
+            'maximumBandWorkers': 4,
+            'mergeSearches': 1,
+            'maximumKeywordsPerSearch': 4,
+            'citiesPerSearch': 100,
+            'cityRevisitDays': 7,
+            'requestsPerHour': 0,
+            'megabytesPerHour': 0
         }
 
         helpers.setOptions('options.ini', self.options)
 
+        self.database = Database('database.sqlite', 'sqlite', self.options['databasePragmas'])
+
+        self.database.makeTables('program/resources/database.json')
+
         if not self.options['useProxies']:
             self.options['proxyListUrl'] = ''
 
         self.options['sites'] = self.options['sites'].split(',')
 
+        self.database.maximumBufferedRows = self.options['databaseBatchSize']
+        self.database.maximumSecondsBetweenFlushes = self.options['databaseFlushSeconds']
+
+        if '--debug' in sys.argv:
+            self.options['secondsBetweenItems'] = 3
+
         self.credentials = {}
 
         helpers.setOptions('user-data/credentials/credentials.ini', self.credentials, '')
@@ -905,13 +2403,13 @@ class Marketplaces:
         self.checkaflip = Checkaflip(self.options)
         self.craigslist = Craigslist(self.options, self.emailer)
 
-        self.averageSellingPrice = ''
+        self.budgetAllocator = BudgetAllocator(self.database, self.options)
 
-        if '--debug' in sys.argv:
-            self.options['secondsBetweenItems'] = 3
+        self.averageSellingPrice = ''
 
         helpers.addToStartup(__file__)
         self.removeOldItems()
 
-marketplaces = Marketplaces()
-marketplaces.run()
\ No newline at end of file
+if __name__ == '__main__':
+    marketplaces = Marketplaces()
+    marketplaces.run()
\ No newline at end of file
@@ -3,18 +3,432 @@ import logging
 import os.path
 import random
 import json
+import time
+import datetime
+import threading
+import email.utils
 import urllib.parse
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 from . import helpers
 
 from .helpers import get
+from .cache import ResponseCache
 
-class Api:
-    def get(self, url, parameters=None, responseIsJson=True, returnResponseObject=False, requestType=None):
+class TokenBucket:
+    def getWait(self, now):
+        self.refill(now)
+
+        if now < self.pausedUntil:
+            return self.pausedUntil - now
+
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # multiplicative decrease
+    def slowDown(self, seconds=0):
+        self.rate = max(self.minimumRate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+        if seconds:
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + seconds)
+
+    # additive increase back to the configured rate
+    def speedUp(self):
+        self.rate = min(self.maximumRate, self.rate + self.maximumRate / 10)
+
+    def __init__(self, rate, capacity, minimumRate):
+        self.maximumRate = rate
+        self.minimumRate = min(rate, minimumRate)
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.pausedUntil = 0
+
+class RateLimiter:
+    def wait(self, url, proxies):
+        buckets = self.getBuckets(url, proxies)
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                seconds = max(bucket.getWait(now) for type, bucket in buckets)
+
+                # only take a token once every bucket has one
+                if seconds <= 0:
+                    for type, bucket in buckets:
+                        bucket.take()
+
+                    return
+
+            if seconds >= 1:
+                self.log.debug(f'Rate limit. Waiting {helpers.fixedDecimals(seconds, 1)} seconds for {self.getHost(url)}.')
+
+            time.sleep(seconds)
+
+    def handleResponse(self, url, proxies, response, seconds):
+        buckets = self.getBuckets(url, proxies)
+
+        statusCode = None
+
+        if response is not None:
+            statusCode = response.status_code
+
+        with self.lock:
+            for type, bucket in buckets:
+                if statusCode in [403, 429]:
+                    retryAfter = self.getRetryAfter(response, bucket)
+
+                    self.log.info(f'Got status {statusCode} from {self.getHost(url)}. Slowing down to {helpers.fixedDecimals(bucket.rate * 60 / 2, 1)} requests per minute for {type}.')
+                    bucket.slowDown(retryAfter)
+                elif statusCode is None or seconds > self.slowResponseSeconds:
+                    # one slow subdomain doesn't mean the whole site is overloaded
+                    if type != 'domain':
+                        bucket.slowDown()
+                else:
+                    bucket.speedUp()
+
+    # retry-after is either a number of seconds or a date
+    def getRetryAfter(self, response, bucket):
+        # no usable hint from the server
+        result = 1 / bucket.minimumRate
+
+        value = response.headers.get('retry-after', '').strip()
+
+        if value.isdigit():
+            result = int(value)
+        elif value:
+            try:
+                date = email.utils.parsedate_to_datetime(value)
+
+                if date.tzinfo is None:
+                    date = date.replace(tzinfo=datetime.timezone.utc)
+
+                result = max(0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+            except (TypeError, ValueError, IndexError):
+                pass
+
+        # a wrong header mustn't stop the site for good
+        result = min(result, self.maximumRetryAfterSeconds)
+
+        return result
+
+    def getBuckets(self, url, proxies):
+        result = []
+
+        host = self.getHost(url)
+
+        if host:
+            result.append(('host', self.getBucket('host', host, self.requestsPerMinutePerHost)))
+
+            domain = self.getDomain(host)
+
+            # the subdomains of a site also share a limit, so being blocked in one city slows down the others
+            if domain != host.split(':')[0]:
+                result.append(('domain', self.getBucket('domain', domain, self.requestsPerMinutePerDomain)))
+
+        proxy = get(proxies, 'http')
+
+        if proxy:
+            result.append(('proxy', self.getBucket('proxy', proxy, self.requestsPerMinutePerProxy)))
+
+        return result
+
+    def getBucket(self, type, key, requestsPerMinute):
+        with self.lock:
+            result = self.buckets.get((type, key))
+
+            if not result:
+                result = TokenBucket(requestsPerMinute / 60, self.burst, self.minimumRate)
+                self.buckets[(type, key)] = result
+
+            return result
+
+    def getHost(self, url):
+        return urllib.parse.urlparse(url).netloc.lower()
+
+    # albuquerque.craigslist.org and images.craigslist.org are both craigslist.org
+    def getDomain(self, host):
+        result = host.split(':')[0]
+
+        labels = result.split('.')
+
+        # an ip address
+        if labels[-1].isdigit():
+            return result
+
+        count = 2
+
+        # for example example.co.uk
+        if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in ['co', 'com', 'org', 'net', 'ac', 'gov', 'edu']:
+            count = 3
+
+        result = '.'.join(labels[-count:])
+
+        return result
+
+    def configure(self, options):
+        if get(options, 'requestsPerMinutePerHost'):
+            self.requestsPerMinutePerHost = options['requestsPerMinutePerHost']
+
+        if get(options, 'requestsPerMinutePerDomain'):
+            self.requestsPerMinutePerDomain = options['requestsPerMinutePerDomain']
+
+        if get(options, 'requestsPerMinutePerProxy'):
+            self.requestsPerMinutePerProxy = options['requestsPerMinutePerProxy']
+
+        if get(options, 'requestBurst'):
+            self.burst = options['requestBurst']
+
+        if get(options, 'slowResponseSeconds'):
+            self.slowResponseSeconds = options['slowResponseSeconds']
+
+        if get(options, 'maximumRetryAfterSeconds'):
+            self.maximumRetryAfterSeconds = options['maximumRetryAfterSeconds']
+
+        # never back off further than the old fixed delay
+        if get(options, 'secondsBetweenItems'):
+            self.minimumRate = 1 / options['secondsBetweenItems']
+
+        self.log = logging.getLogger(get(options, 'loggerName'))
+
+    def __init__(self):
+        self.requestsPerMinutePerHost = 60
+        self.requestsPerMinutePerDomain = 180
+        self.requestsPerMinutePerProxy = 120
+        self.burst = 5
+        self.slowResponseSeconds = 10
+        self.maximumRetryAfterSeconds = 600
+        self.minimumRate = 1 / 30
+        self.buckets = {}
+        self.lock = threading.RLock()
+        self.log = logging.getLogger()
+
+# keep-alive sessions so requests to the same host through the same proxy reuse a connection
+class SessionPool:
+    def getSession(self, url, proxies):
+        key = (get(proxies, 'http'), urllib.parse.urlparse(url).netloc.lower())
+
+        with self.lock:
+            now = time.monotonic()
+
+            self.removeIdle(now)
+
+            item = self.sessions.pop(key, None)
+
+            if not item:
+                item = {
+                    'session': self.getNewSession()
+                }
+
+            item['lastUsed'] = now
+
+            # most recently used goes last
+            self.sessions[key] = item
+
+            while len(self.sessions) > self.maximumSessions:
+                oldestKey, oldest = self.sessions.popitem(last=False)
+                oldest['session'].close()
+
+            return item['session']
+
+    def getNewSession(self):
         import requests
+        import http.cookiejar
+
+        result = requests.Session()
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.connectionsPerSession)
+        result.mount('http://', adapter)
+        result.mount('https://', adapter)
+
+        # stay stateless like plain requests.get
+        result.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+        return result
+
+    def removeIdle(self, now):
+        for key in list(self.sessions.keys()):
+            item = self.sessions[key]
+
+            if now - item['lastUsed'] < self.sessionIdleSeconds:
+                continue
+
+            item['session'].close()
+            del self.sessions[key]
+
+    def close(self):
+        with self.lock:
+            for item in self.sessions.values():
+                item['session'].close()
+
+            self.sessions.clear()
+
+    def configure(self, options):
+        if get(options, 'maximumSessions'):
+            self.maximumSessions = options['maximumSessions']
+
+        if get(options, 'connectionsPerSession'):
+            self.connectionsPerSession = options['connectionsPerSession']
+
+        if get(options, 'sessionIdleSeconds'):
+            self.sessionIdleSeconds = options['sessionIdleSeconds']
 
+    def __init__(self):
+        self.maximumSessions = 50
+        self.connectionsPerSession = 10
+        self.sessionIdleSeconds = 60
+        self.sessions = OrderedDict()
+        self.lock = threading.RLock()
+
+class BudgetExceeded(Exception):
+    pass
+
+# hourly limits on how many requests and bytes the app uses. the allowance is the part of that the current job can use.
+class RequestBudget:
+    def check(self):
+        reason = self.getExhaustedReason()
+
+        if reason:
+            self.refuse()
+            raise BudgetExceeded(reason)
+
+    # a job that used exactly its allowance is still complete. only refused work means it must run again.
+    def refuse(self):
+        with self.lock:
+            self.refused = True
+
+    def wasRefused(self):
+        with self.lock:
+            return self.refused
+
+    def isExhausted(self):
+        return bool(self.getExhaustedReason())
+
+    def getExhaustedReason(self):
+        result = ''
+
+        with self.lock:
+            self.removeOld(time.time())
+
+            if self.requestsPerHour and self.requests >= self.requestsPerHour:
+                result = f'Used the budget of {self.requestsPerHour} requests per hour'
+            elif self.bytesPerHour and self.bytes >= self.bytesPerHour:
+                result = f'Used the budget of {helpers.fixedDecimals(self.bytesPerHour / 1000 / 1000, 1)} megabytes per hour'
+            elif self.allowance and self.allowance['requests'] is not None and self.allowance['spentRequests'] >= self.allowance['requests']:
+                result = f'Used the {self.allowance["requests"]} requests for this item'
+            elif self.allowance and self.allowance['bytes'] is not None and self.allowance['spentBytes'] >= self.allowance['bytes']:
+                result = f'Used the {helpers.fixedDecimals(self.allowance["bytes"] / 1000 / 1000, 1)} megabytes for this item'
+
+        return result
+
+    # timestamp is for requests from earlier runs
+    def add(self, bytes, requests=1, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.lock:
+            self.window.append((timestamp, requests, bytes))
+
+            self.requests += requests
+            self.bytes += bytes
+
+            if self.allowance and timestamp > self.allowance['started']:
+                self.allowance['spentRequests'] += requests
+                self.allowance['spentBytes'] += bytes
+
+    def removeOld(self, now):
+        while self.window and self.window[0][0] < now - 60 * 60:
+            timestamp, requests, bytes = self.window.popleft()
+
+            self.requests -= requests
+            self.bytes -= bytes
+
+    # None means no limit
+    def getAvailable(self):
+        result = {
+            'requests': None,
+            'bytes': None
+        }
+
+        with self.lock:
+            self.removeOld(time.time())
+
+            if self.requestsPerHour:
+                result['requests'] = max(0, self.requestsPerHour - self.requests)
+
+            if self.bytesPerHour:
+                result['bytes'] = max(0, self.bytesPerHour - self.bytes)
+
+        return result
+
+    def startAllowance(self, requests=None, bytes=None):
+        with self.lock:
+            self.refused = False
+            self.allowance = {
+                'requests': requests,
+                'bytes': bytes,
+                'spentRequests': 0,
+                'spentBytes': 0,
+                'started': time.time()
+            }
+
+    # returns what was spent
+    def stopAllowance(self):
+        result = {
+            'requests': 0,
+            'bytes': 0
+        }
+
+        with self.lock:
+            if self.allowance:
+                result['requests'] = self.allowance['spentRequests']
+                result['bytes'] = self.allowance['spentBytes']
+
+            self.allowance = None
+
+        return result
+
+    def configure(self, options):
+        if get(options, 'requestsPerHour'):
+            self.requestsPerHour = options['requestsPerHour']
+
+        if get(options, 'megabytesPerHour'):
+            self.bytesPerHour = options['megabytesPerHour'] * 1000 * 1000
+
+    def __init__(self):
+        self.requestsPerHour = 0
+        self.bytesPerHour = 0
+        self.window = deque()
+        self.requests = 0
+        self.bytes = 0
+        self.allowance = None
+        self.refused = False
+        self.lock = threading.RLock()
+
+# shared by all Api objects so limits apply across them
+rateLimiter = RateLimiter()
+
+requestBudget = RequestBudget()
+
+sessionPool = SessionPool()
+
+responseCache = ResponseCache()
+
+class Api:
+    def get(self, url, parameters=None, responseIsJson=True, returnResponseObject=False, requestType=None):
         result = ''
 
         if responseIsJson:
@@ -44,10 +458,12 @@ class Api:
                     else:
                         return result
 
+            method = 'GET'
+
             if requestType == 'DELETE':
-                response = requests.delete(self.urlPrefix + url, params=parameters, headers=self.headers, proxies=self.proxies, timeout=self.timeout, verify=verify)
-            else:
-                response = requests.get(self.urlPrefix + url, params=parameters, headers=self.headers, proxies=self.proxies, timeout=self.timeout, verify=verify)
+                method = 'DELETE'
+
+            response = self.send(method, url, parameters, None, verify)
 
             self.handleResponseLog(url, parameters, response, fileName)
             
@@ -58,6 +474,8 @@ class Api:
             else:
                 result = response.text
         
+        except BudgetExceeded as e:
+            self.log.info(f'Skipping {url}. {e}.')
         except Exception as e:
             if 'Max retries exceeded with url' in str(e):
                 helpers.handleException(e, None, self.log.name, True)
@@ -66,6 +484,117 @@ class Api:
         
         return result
 
+    def send(self, method, url, parameters, data, verify, maximumBytes=None):
+        fullUrl = self.urlPrefix + url
+        
+        cacheUrl = fullUrl
+
+        if parameters:
+            cacheUrl += '?' + urllib.parse.urlencode(parameters)
+
+        cached = self.responseCache.get(method, cacheUrl, data)
+
+        if get(cached, 'isFresh'):
+            self.log.debug('Using cached response')
+            return self.responseCache.getResponse(cached)
+
+        headers = self.headers
+
+        # ask the server whether the cached copy is still good
+        if cached:
+            headers = OrderedDict(self.headers)
+            headers.update(self.responseCache.getConditionalHeaders(cached))
+
+        # cached responses are free
+        self.requestBudget.check()
+
+        self.rateLimiter.wait(fullUrl, self.proxies)
+
+        started = time.monotonic()
+        response = None
+
+        session = self.sessionPool.getSession(fullUrl, self.proxies)
+
+        stream = maximumBytes is not None
+
+        try:
+            response = session.request(method, fullUrl, params=parameters, data=data, headers=headers, proxies=self.proxies, timeout=self.timeout, verify=verify, stream=stream)
+        except Exception as e:
+            # failed requests count too
+            self.requestBudget.add(0)
+            raise e
+        finally:
+            self.rateLimiter.handleResponse(fullUrl, self.proxies, response, time.monotonic() - started)
+
+        if stream:
+            size = self.readLimited(response, maximumBytes)
+        else:
+            size = len(response.content)
+
+        self.requestBudget.add(size)
+
+        if cached and response.status_code == 304:
+            self.log.debug('Cached response is still valid')
+            self.responseCache.refresh(cached)
+            return self.responseCache.getResponse(cached)
+
+        self.responseCache.put(method, cacheUrl, data, response)
+
+        return response
+
+    # stops downloading once the body is bigger than maximumBytes. the content is then empty.
+    # returns how many bytes were downloaded, which the budget counts even when the body was too big.
+    def readLimited(self, response, maximumBytes):
+        chunks = []
+        size = 0
+
+        try:
+            for chunk in response.iter_content(65536):
+                size += len(chunk)
+
+                if size > maximumBytes:
+                    self.log.warning(f'{response.url} is larger than {maximumBytes} bytes. Skipping it.')
+                    chunks = []
+                    break
+
+                chunks.append(chunk)
+        finally:
+            response.close()
+
+        response._content = b''.join(chunks)
+        response._content_consumed = True
+
+        return size
+
+    def getBinary(self, url, maximumBytes=None):
+        result = b''
+
+        try:
+            self.log.debug(f'Get {url}')
+
+            verify = True
+
+            if '--debug' in sys.argv and self.proxies and 'localhost:' in self.proxies.get('http', ''):
+                verify = False
+
+            response = self.send('GET', url, None, None, verify, maximumBytes)
+
+            if response.status_code != 200:
+                self.log.debug(f'Status code for {url}: {response.status_code}')
+                return result
+
+            result = response.content
+        except BudgetExceeded as e:
+            self.log.info(f'Skipping {url}. {e}.')
+        except Exception as e:
+            helpers.handleException(e, None, self.log.name)
+
+        return result
+
+    def close(self):
+        self.sessionPool.close()
+        self.responseCache.close()
+
     def getPlain(self, url):
         result = self.get(url, None, False)
 
@@ -93,8 +622,6 @@ class Api:
         return result
 
     def post(self, url, data, responseIsJson=True):
-        import requests
-        
         result = {}
 
         if not responseIsJson:
@@ -117,7 +644,7 @@ class Api:
                 # don't want to read files for post, just write them
                 fileName = self.getCacheFileName(url, {}, responseIsJson)
 
-            response = requests.post(self.urlPrefix + url, headers=self.headers, proxies=self.proxies, data=data, timeout=self.timeout, verify=verify)
+            response = self.send('POST', url, None, data, verify)
 
             self.handleResponseLog(url, {}, response, fileName)
 
@@ -125,6 +652,8 @@ class Api:
                 result = json.loads(response.text)
             else:
                 result = response.text
+        except BudgetExceeded as e:
+            self.log.info(f'Skipping {url}. {e}.')
         except Exception as e:
             helpers.handleException(e)
 
@@ -346,6 +875,17 @@ class Api:
         self.requestIndex = 0
         self.log = logging.getLogger(get(options, 'loggerName'))
 
+        self.rateLimiter = rateLimiter
+        self.sessionPool = sessionPool
+        self.responseCache = responseCache
+        self.requestBudget = requestBudget
+
+        if options:
+            self.rateLimiter.configure(options)
+            self.requestBudget.configure(options)
+            self.sessionPool.configure(options)
+            self.responseCache.configure(options)
+
         self.randomizeHeaders()
 
         if not self.headers:
@@ -1,3 +1,5 @@
+import io
+import threading
 import logging
 import json
 import requests
@@ -5,23 +7,84 @@ import requests
 # pip packages
 import boto3
 
+from botocore.exceptions import BotoCoreError, ClientError
+
 from ..library import helpers
 
 from ..library.helpers import get
+from ..library.labelcache import LabelCache
+
+# shared by all clients
+labelCache = LabelCache()
 
 class Aws:
     def detect_labels_local_file(self, fileName):
-        self.initialize()
-
         with open(fileName, 'rb') as image:
-            response = self.client.detect_labels(Image={'Bytes': image.read()})
+            return self.detectLabels(image.read())
 
+    def detectLabels(self, imageBytes):
+        hashes = labelCache.getHashes(imageBytes)
+
+        result = labelCache.get(hashes)
+
+        if result is not None:
+            logging.debug('Using cached labels')
+            return result
+
+        self.initialize()
+
+        # throttled or refused. the picture counts as having no labels and isn't cached, so it's checked again next time.
+        try:
+            response = self.client.detect_labels(Image={'Bytes': self.getSmallerImage(imageBytes)})
+        except (BotoCoreError, ClientError) as e:
+            helpers.handleException(e, 'Could not detect labels')
+            return []
 
         logging.debug('Response: ' + json.dumps(response))
 
-        return response.get('Labels', '')
+        result = response.get('Labels', '')
+
+        labelCache.put(hashes, result)
+
+        return result
+
+    # rekognition doesn't need a big picture to find things in it. smaller uploads are faster.
+    def getSmallerImage(self, imageBytes):
+        result = imageBytes
+
+        if not self.hasPillow:
+            return result
+
+        try:
+            from PIL import Image
+
+            image = Image.open(io.BytesIO(imageBytes))
+
+            if max(image.size) <= self.maximumPictureDimension:
+                return result
+
+            image = image.convert('RGB')
+            image.thumbnail((self.maximumPictureDimension, self.maximumPictureDimension), Image.LANCZOS)
+
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=85)
+
+            logging.debug(f'Reduced picture from {len(imageBytes)} to {output.tell()} bytes')
+
+            result = output.getvalue()
+        except Exception as e:
+            helpers.handleException(e, 'Could not resize picture', None, True)
+
+        return result
+
+    def close(self):
+        labelCache.close()
     
     def initialize(self):
+        with self.lock:
+            self.initializeOnce()
+
+    def initializeOnce(self):
         if self.initialized:
             return
 
@@ -44,7 +107,15 @@ class Aws:
             region_name='us-east-2'
         )
 
-    def __init__(self, options):
-        self.initialized = False
+    # client is a rekognition client to use instead of the one made from awsResourceUrl
+    def __init__(self, options, client=None):
+        self.initialized = client is not None
+        self.lock = threading.Lock()
         self.options = options
-        self.client = None
\ No newline at end of file
+        self.client = client
+
+        self.maximumPictureDimension = get(options, 'maximumPictureDimension') or 800
+
+        labelCache.configure(options)
+
+        self.hasPillow = labelCache.hasPillow
\ No newline at end of file
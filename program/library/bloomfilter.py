@@ -0,0 +1,46 @@
+import math
+
+# can say "maybe seen" for something it hasn't seen, but never "not seen" for something it has
+class BloomFilter:
+    def add(self, key):
+        first, second = self.getHashes(key)
+
+        for i in range(self.numberOfHashes):
+            index = (first + i * second) % self.numberOfBits
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+        self.count += 1
+
+    def __contains__(self, key):
+        first, second = self.getHashes(key)
+
+        bits = self.bits
+        numberOfBits = self.numberOfBits
+
+        for i in range(self.numberOfHashes):
+            index = (first + i * second) % numberOfBits
+
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+
+        return True
+
+    def isFull(self):
+        return self.count > self.capacity
+
+    # double hashing. one 64 bit hash gives all the indexes.
+    # python randomizes string hashes per process, so this is only for in-memory use.
+    def getHashes(self, key):
+        h = hash(key) & 0xffffffffffffffff
+
+        return h & 0xffffffff, (h >> 32) | 1
+
+    def __init__(self, capacity, falsePositiveRate=0.01):
+        self.capacity = max(1, capacity)
+        self.count = 0
+
+        # standard sizing formulas
+        self.numberOfBits = int(math.ceil(-self.capacity * math.log(falsePositiveRate) / (math.log(2) ** 2)))
+        self.numberOfHashes = max(1, int(round(self.numberOfBits / self.capacity * math.log(2))))
+
+        self.bits = bytearray((self.numberOfBits + 7) // 8)
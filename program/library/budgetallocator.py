@@ -0,0 +1,188 @@
+import time
+import logging
+
+from . import helpers
+
+from .api import requestBudget
+
+# splits the hourly request budget between the input rows and sites.
+# a job is one input row on one site. rows whose matches were worth more per request get a bigger part.
+class BudgetAllocator:
+    def start(self, jobs):
+        self.pending = {}
+
+        for site, item in jobs:
+            self.pending[self.getKey(site, item)] = self.getWeight(site, item)
+
+    def startJob(self, jobs):
+        self.jobs = jobs
+
+        available = requestBudget.getAvailable()
+
+        weights = {self.getKey(site, item): self.getWeight(site, item) for site, item in jobs}
+
+        weight = sum(weights.values())
+        others = sum(value for key, value in self.pending.items() if not key in weights)
+
+        # the rest is kept for the jobs that haven't run yet
+        share = weight / (weight + others)
+
+        requests = None
+        bytes = None
+
+        # at least one request, or nothing could ever be learned about the row
+        if available['requests'] is not None:
+            requests = max(min(1, available['requests']), int(available['requests'] * share))
+
+        if available['bytes'] is not None:
+            bytes = int(available['bytes'] * share)
+
+        if requests is not None or bytes is not None:
+            logging.info(f'Budget for this item: {self.getAmount(requests, bytes)}.')
+
+        requestBudget.startAllowance(requests, bytes)
+
+    # what was spent is divided between the jobs by weight. values are by keyword.
+    def stopJob(self, values):
+        spent = requestBudget.stopAllowance()
+
+        jobs = self.jobs
+        self.jobs = []
+
+        weights = [self.getWeight(site, item) for site, item in jobs]
+        totalWeight = sum(weights)
+
+        for (site, item), weight in zip(jobs, weights):
+            self.removeJob(site, item)
+
+            share = 1 / len(jobs)
+
+            if totalWeight > 0:
+                share = weight / totalWeight
+
+            siteName = helpers.getDomainName(site)
+            keyword = self.normalize(item.get('keyword', ''))
+
+            total = self.spending.setdefault((siteName, keyword), {
+                'requests': 0,
+                'bytes': 0,
+                'results': 0,
+                'profit': 0
+            })
+
+            total['requests'] += spent['requests'] * share
+            total['bytes'] += spent['bytes'] * share
+
+            # the same keyword can be in several jobs, but its value only counts once
+            value = values.pop(keyword, None)
+
+            if value:
+                total['results'] += value['results']
+                total['profit'] += value['profit']
+
+    def removeJob(self, site, item):
+        self.pending.pop(self.getKey(site, item), None)
+
+    # expected profit per request times how many requests the job usually needs
+    def getWeight(self, site, item):
+        siteName = helpers.getDomainName(site)
+        keyword = self.normalize(item.get('keyword', ''))
+
+        row = self.history.get(keyword, {})
+
+        # rows with little history are assumed to be average
+        requests = row.get('requests', 0) + self.priorRequests
+        profit = row.get('profit', 0) + self.priorRequests * self.averageValuePerRequest
+
+        valuePerRequest = max(profit / requests, self.averageValuePerRequest / 10, 0.001)
+
+        usualRequests = self.usualRequests.get((siteName, keyword), self.usualRequests.get(siteName, 1))
+
+        return valuePerRequest * max(usualRequests, 1)
+
+    def getKey(self, site, item):
+        return (site, id(item))
+
+    def normalize(self, keyword):
+        return ' '.join(keyword.casefold().split())
+
+    def getAmount(self, requests, bytes):
+        result = []
+
+        if requests is not None:
+            result.append(f'{int(requests)} requests')
+
+        if bytes is not None:
+            result.append(f'{helpers.fixedDecimals(bytes / 1000 / 1000, 1)} megabytes')
+
+        return ' and '.join(result)
+
+    def getSummary(self):
+        result = []
+
+        for key, total in self.spending.items():
+            siteName, keyword = key
+
+            result.append(f'Site: {siteName}. Keyword: {keyword}. Spent {self.getAmount(total["requests"], total["bytes"])}. Results: {total["results"]}. Profit: {int(total["profit"])}.')
+
+        return result
+
+    def save(self):
+        now = int(time.time())
+
+        for line in self.getSummary():
+            logging.info(line)
+
+        for key, total in self.spending.items():
+            siteName, keyword = key
+
+            self.database.insertLater('budgetHistory', {
+                'siteName': siteName,
+                'keyword': keyword,
+                'requests': int(round(total['requests'])),
+                'bytes': int(round(total['bytes'])),
+                'results': total['results'],
+                'profit': int(round(total['profit'])),
+                'gmTimestamp': now
+            })
+
+        self.spending = {}
+
+    # earlier runs count towards the budget for this hour
+    def load(self):
+        minimumTimestamp = int(time.time()) - self.options['maximumDaysToKeepItems'] * 24 * 60 * 60
+
+        for row in self.database.iterate('select requests, bytes, gmTimestamp from budgetHistory where gmTimestamp >= ?', [int(time.time()) - 60 * 60]):
+            requestBudget.add(row['bytes'], row['requests'], row['gmTimestamp'])
+
+        rows = self.database.getRows('select keyword, sum(requests) as requests, sum(profit) as profit from budgetHistory where gmTimestamp >= ? group by keyword', [minimumTimestamp])
+
+        self.history = {row['keyword']: row for row in rows}
+
+        totalRequests = sum(row['requests'] for row in rows)
+        totalProfit = sum(row['profit'] for row in rows)
+
+        if totalRequests:
+            self.averageValuePerRequest = max(totalProfit / totalRequests, 0.001)
+
+        # how many requests each site and keyword needs in a run
+        for row in self.database.getRows('select siteName, keyword, avg(requests) as requests from budgetHistory where gmTimestamp >= ? group by siteName, keyword', [minimumTimestamp]):
+            self.usualRequests[(row['siteName'], row['keyword'])] = row['requests']
+
+        for row in self.database.getRows('select siteName, avg(requests) as requests from budgetHistory where gmTimestamp >= ? group by siteName', [minimumTimestamp]):
+            self.usualRequests[row['siteName']] = row['requests']
+
+    def __init__(self, database, options):
+        self.database = database
+        self.options = options
+        self.pending = {}
+        self.jobs = []
+        self.spending = {}
+        self.history = {}
+        self.usualRequests = {}
+        self.averageValuePerRequest = 1
+
+        # how many requests of history it takes to move a row away from the average
+        self.priorRequests = 100
+
+        self.load()
@@ -0,0 +1,253 @@
+import os
+import sys
+import re
+import json
+import time
+import logging
+import hashlib
+import threading
+
+from . import helpers
+
+from .helpers import get
+from .database import Database
+
+# stores responses by url. bodies are stored once per unique content.
+class ResponseCache:
+    def get(self, method, url, data=None):
+        result = {}
+
+        if not self.canCache(method, url):
+            return result
+
+        self.initialize()
+
+        key = self.getKey(method, url, data)
+
+        row = self.database.getFirst('response', '*', 'key = ?', parameters=[key])
+
+        if not row:
+            self.misses += 1
+            return result
+
+        fileName = self.getBodyFileName(row.get('hash', ''))
+
+        if not os.path.exists(fileName):
+            self.database.execute('delete from response where key = ?', False, [key])
+            self.misses += 1
+            return result
+
+        result = row
+        result['isFresh'] = row.get('expires', 0) > int(time.time())
+
+        if result['isFresh']:
+            self.hits += 1
+            self.touch(key)
+        else:
+            self.stale += 1
+
+        return result
+
+    def put(self, method, url, data, response):
+        if not self.canCache(method, url):
+            return
+
+        if response is None or response.status_code != 200 or not response.content:
+            return
+
+        self.initialize()
+
+        now = int(time.time())
+
+        hash = hashlib.sha256(response.content).hexdigest()
+
+        fileName = self.getBodyFileName(hash)
+
+        # same content is only stored once
+        if not os.path.exists(fileName):
+            helpers.makeDirectory(os.path.dirname(fileName))
+            helpers.toBinaryFile(response.content, fileName)
+
+        newItem = {
+            'key': self.getKey(method, url, data),
+            'url': url,
+            'hash': hash,
+            'size': len(response.content),
+            'headers': json.dumps(dict(response.headers)),
+            'etag': response.headers.get('etag', ''),
+            'lastModified': response.headers.get('last-modified', ''),
+            'gmDate': now,
+            'expires': now + self.getTimeToLive(url),
+            'lastUsed': now
+        }
+
+        self.database.insert('response', newItem)
+
+        with self.lock:
+            self.writes += 1
+
+            if self.writes % 50 == 0:
+                self.evict()
+
+    # a 304 means the cached copy is still good
+    def refresh(self, row):
+        now = int(time.time())
+        expires = now + self.getTimeToLive(row.get('url', ''))
+        key = row.get('key', '')
+
+        self.database.execute('update response set expires = ?, lastUsed = ? where key = ?', False, [expires, now, key])
+
+        self.revalidated += 1
+
+    def touch(self, key):
+        now = int(time.time())
+
+        self.database.execute('update response set lastUsed = ? where key = ?', False, [now, key])
+
+    def getConditionalHeaders(self, row):
+        result = {}
+
+        if get(row, 'etag'):
+            result['if-none-match'] = row['etag']
+
+        if get(row, 'lastModified'):
+            result['if-modified-since'] = row['lastModified']
+
+        return result
+
+    def getResponse(self, row):
+        import requests
+
+        result = requests.models.Response()
+
+        result._content = helpers.getBinaryFile(self.getBodyFileName(row.get('hash', '')))
+        result.status_code = 200
+        result.url = row.get('url', '')
+        result.headers = requests.structures.CaseInsensitiveDict(json.loads(row.get('headers', '{}')))
+        result.encoding = requests.utils.get_encoding_from_headers(result.headers)
+
+        return result
+
+    # least recently used first until the total size is under the limit
+    def evict(self):
+        maximumSize = self.maximumMegabytes * 1000 * 1000
+
+        row = self.database.getFirst('(select distinct hash, size from response)', 'sum(size) as total', '')
+        total = get(row, 'total')
+
+        if not total or total <= maximumSize:
+            return
+
+        logging.debug(f'Cache is {total} bytes. Removing least recently used responses.')
+
+        rows = self.database.get('response', 'key, hash, size', '', 'lastUsed', 'asc', 1000)
+
+        hashes = []
+
+        for row in rows:
+            if total <= maximumSize:
+                break
+
+            self.database.execute('delete from response where key = ?', False, [row['key']])
+
+            if not row['hash'] in hashes:
+                hashes.append(row['hash'])
+                total -= row['size']
+
+        for hash in hashes:
+            if self.database.getFirst('response', 'key', 'hash = ?', parameters=[hash]):
+                continue
+
+            helpers.removeFile(self.getBodyFileName(hash))
+
+    def canCache(self, method, url):
+        if '--noCache' in sys.argv:
+            return False
+
+        return self.getTimeToLive(url) > 0
+
+    def getTimeToLive(self, url):
+        result = 0
+
+        for pattern, seconds in self.rules:
+            if re.search(pattern, url):
+                result = seconds
+                break
+
+        return result
+
+    def getKey(self, method, url, data):
+        s = f'{method} {url}'
+
+        if data:
+            if not isinstance(data, str):
+                data = json.dumps(data, sort_keys=True)
+
+            s += ' ' + data
+
+        return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+    def getBodyFileName(self, hash):
+        return os.path.join(self.directory, 'bodies', hash[0:2], hash)
+
+    def getStatistics(self):
+        return f'Cache hits: {self.hits}. Misses: {self.misses}. Stale: {self.stale}. Revalidated: {self.revalidated}.'
+
+    # pattern=seconds;pattern=seconds. first matching pattern wins.
+    def setRules(self, string):
+        self.rules = []
+
+        for rule in string.split(';'):
+            if not '=' in rule:
+                continue
+
+            pattern = helpers.findBetween(rule, '', '=')
+            seconds = helpers.findBetween(rule, '=', '')
+
+            self.rules.append((pattern.strip(), int(seconds)))
+
+    def initialize(self):
+        with self.lock:
+            if self.database:
+                return
+
+            helpers.makeDirectory(self.directory)
+
+            self.database = Database(os.path.join(self.directory, 'cache.sqlite'))
+
+            self.database.execute('create table if not exists response ( key text, url text, hash text, size integer, headers text, etag text, lastModified text, gmDate integer, expires integer, lastUsed integer, primary key(key) )')
+            self.database.execute('create index if not exists response_lastUsed on response (lastUsed)')
+            self.database.execute('create index if not exists response_hash on response (hash)')
+
+    def configure(self, options):
+        if get(options, 'cacheRules'):
+            self.setRules(options['cacheRules'])
+
+        if get(options, 'maximumCacheMegabytes'):
+            self.maximumMegabytes = options['maximumCacheMegabytes']
+
+    def close(self):
+        with self.lock:
+            if not self.database:
+                return
+
+            logging.debug(self.getStatistics())
+
+            self.database.close()
+            self.database = None
+
+    def __init__(self, directory='user-data/cache'):
+        self.directory = directory
+        self.database = None
+        self.maximumMegabytes = 500
+        self.lock = threading.RLock()
+        self.rules = []
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.writes = 0
+
+        # search pages must stay fresh. listings and prices don't change much.
+        # pictures aren't kept. only what was found in them is, in the label cache.
+        self.setRules(r'/search/=0;craigslist\.org/.*\.html=86400;checkaflip\.com/api=21600')
@@ -0,0 +1,178 @@
+import time
+import random
+import logging
+import threading
+
+# picks which cities to search for a keyword, so cities that found matches before are searched more often.
+# each city's chance of a match is drawn at random from what it found so far (thompson sampling),
+# so cities with little history still get a turn.
+# what each city found is kept for each input row, so it still applies when the rows are searched together differently.
+class CityScheduler:
+    def getCities(self, siteName, query, cities):
+        result = cities
+
+        self.siteName = siteName
+        self.keys = []
+        self.rowStatistics = {}
+
+        for target in query['targets']:
+            key = self.getKey(target['item'])
+
+            if key in self.keys:
+                continue
+
+            self.keys.append(key)
+
+            keyword, category = key
+
+            rows = self.database.get('cityYield', '*', 'siteName = ? and keyword = ? and category = ?', '', '', None, [siteName, keyword, category], False)
+
+            self.rowStatistics[key] = {row['city']: row for row in rows}
+
+        self.statistics = self.getCombinedStatistics()
+
+        maximumCities = self.options['citiesPerSearch']
+
+        if maximumCities <= 0 or len(cities) <= maximumCities:
+            return result
+
+        # cities that weren't searched for a while get up to half the turns
+        minimumTimestamp = int(time.time()) - self.options['cityRevisitDays'] * 24 * 60 * 60
+
+        due = [city for city in cities if self.getLastPolled(city) < minimumTimestamp]
+        due = sorted(due, key=self.getLastPolled)[:maximumCities // 2]
+
+        averageProfit = self.getAverageProfit()
+
+        others = [city for city in cities if not city in due]
+        others = sorted(others, key=lambda city: self.getScore(city, averageProfit), reverse=True)
+
+        result = others[:maximumCities - len(due)] + due
+
+        logging.info(f'Searching {len(result)} of {len(cities)} cities. {len(due)} of them were not searched for {self.options["cityRevisitDays"]} days.')
+
+        return result
+
+    # a random draw of the chance of a match times what a match is usually worth
+    def getScore(self, city, averageProfit):
+        row = self.statistics.get(city.get('url', ''), {})
+
+        polls = row.get('polls', 0)
+        matchingPolls = row.get('matchingPolls', 0)
+        matches = row.get('matches', 0)
+
+        chance = random.betavariate(1 + matchingPolls, 1 + polls - matchingPolls)
+
+        profit = averageProfit
+
+        if matches:
+            profit = row.get('profit', 0) / matches
+
+        return chance * max(profit, 1)
+
+    def getAverageProfit(self):
+        profit = sum(row['profit'] for row in self.statistics.values())
+        matches = sum(row['matches'] for row in self.statistics.values())
+
+        if not matches:
+            return 1
+
+        return profit / matches
+
+    # a search for several rows is as good as the rows together.
+    # a city is only as recently searched as the row that was searched there longest ago.
+    def getCombinedStatistics(self):
+        result = {}
+
+        for statistics in self.rowStatistics.values():
+            for cityUrl in statistics:
+                result.setdefault(cityUrl, {
+                    'polls': 0,
+                    'matchingPolls': 0,
+                    'matches': 0,
+                    'profit': 0,
+                    'gmTimestamp': min(self.rowStatistics[key].get(cityUrl, {}).get('gmTimestamp', 0) for key in self.keys)
+                })
+
+        for statistics in self.rowStatistics.values():
+            for cityUrl, row in statistics.items():
+                for name in ['polls', 'matchingPolls', 'matches', 'profit']:
+                    result[cityUrl][name] += row[name]
+
+        return result
+
+    def getLastPolled(self, city):
+        row = self.statistics.get(city.get('url', ''), {})
+
+        return row.get('gmTimestamp', 0)
+
+    def addPoll(self, cityUrl):
+        with self.lock:
+            self.counts.setdefault(cityUrl, self.getNewCounts())
+
+    def addListing(self, cityUrl):
+        with self.lock:
+            self.counts.setdefault(cityUrl, self.getNewCounts())['newListings'] += 1
+
+    # item is the input row the listing matched. cityUrl is the city whose search found it, even if the listing is from a nearby city.
+    def addMatch(self, item, cityUrl, profit):
+        if not cityUrl:
+            return
+
+        key = self.getKey(item)
+
+        with self.lock:
+            counts = self.counts.setdefault(cityUrl, self.getNewCounts())
+
+            counts['matches'][key] = counts['matches'].get(key, 0) + 1
+            counts['profit'][key] = counts['profit'].get(key, 0) + profit
+
+    def getNewCounts(self):
+        return {
+            'newListings': 0,
+            'matches': {},
+            'profit': {}
+        }
+
+    def getKey(self, item):
+        keyword = ' '.join(item.get('keyword', '').casefold().split())
+        category = item.get('craigslist category', '') or 'sss'
+
+        return (keyword, category)
+
+    def save(self):
+        now = int(time.time())
+
+        with self.lock:
+            for key in self.keys:
+                keyword, category = key
+
+                for cityUrl, counts in self.counts.items():
+                    row = self.rowStatistics[key].get(cityUrl, {})
+
+                    matches = counts['matches'].get(key, 0)
+
+                    self.database.insertLater('cityYield', {
+                        'siteName': self.siteName,
+                        'city': cityUrl,
+                        'keyword': keyword,
+                        'category': category,
+                        'polls': row.get('polls', 0) + 1,
+                        'matchingPolls': row.get('matchingPolls', 0) + int(matches > 0),
+                        'newListings': row.get('newListings', 0) + counts['newListings'],
+                        'matches': row.get('matches', 0) + matches,
+                        'profit': row.get('profit', 0) + int(round(counts['profit'].get(key, 0))),
+                        'gmTimestamp': now
+                    })
+
+            self.counts = {}
+
+    def __init__(self, database, options):
+        self.database = database
+        self.options = options
+        self.lock = threading.RLock()
+        self.statistics = {}
+        self.rowStatistics = {}
+        self.counts = {}
+        self.siteName = ''
+        self.keys = []
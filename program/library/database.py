@@ -3,34 +3,36 @@ import sys
 import sqlite3
 import logging
 import time
-import random
+import threading
+import contextlib
+import types
 
 from . import helpers
 
 from .helpers import get
 
 class Database:
-    def execute(self, statement, returnResult=False):
-        self.executeWithRetries(statement)
+    def execute(self, statement, returnResult=False, parameters=None):
+        with self.getLock():
+            self.executeAndCommit(statement, parameters)
 
-        if not returnResult:
-            return
-        
-        try:
-            rows = self.cursor.fetchall()
-
-            result = []
-        
-            for row in rows:
-                result.append(dict(row))
+            if not returnResult:
+                return
+            
+            try:
+                rows = self.cursor.fetchall()
 
-            return result
-        except Exception as e:
-            self.handleException(e)
+                result = []
+            
+                for row in rows:
+                    result.append(dict(row))
 
-    def get(self, table, columns, where, orderBy, orderType, limit=None):
-        result = []
+                return result
+            except Exception as e:
+                self.handleException(e)
 
+    # where can use ? for values given in parameters
+    def get(self, table, columns, where, orderBy, orderType, limit=None, parameters=None, flush=True):
         wherePart = ''
         orderByPart = ''
         limitPart = ''
@@ -46,48 +48,118 @@ class Database:
 
         query = f'select {columns} from {table}{wherePart}{orderByPart}{limitPart};'
 
-        self.executeWithRetries(query)
+        return self.getRows(query, parameters, flush)
 
-        try:
-            rows = self.cursor.fetchall()
+    def getFirst(self, table, columns, where, orderBy=None, orderType=None, parameters=None, flush=True):
+        result = {}
 
-            for row in rows:
-                result.append(dict(row))
-        except Exception as e:
-            self.handleException(e)
+        rows = self.get(table, columns, where, orderBy, orderType, 1, parameters, flush)
+
+        if len(rows) > 0:
+            result = rows[0]
 
         return result
 
-    def getFirst(self, table, columns, where, orderBy=None, orderType=None):
-        result = {}
+    def getRows(self, statement, parameters=None, flush=True):
+        result = []
 
-        rows = self.get(table, columns, where, orderBy, orderType, 1)
+        for row in self.iterate(statement, parameters, flush=flush):
+            result.append(dict(row))
 
-        if len(rows) > 0:
-            result = rows[0]
+        return result
+
+    def getFirstRow(self, statement, parameters=None):
+        result = {}
+
+        for row in self.iterate(statement, parameters, 1):
+            result = dict(row)
+            break
 
         return result
 
-    def executeWithRetries(self, query):
-        maximumTries = 1000
+    # yields rows a batch at a time instead of loading them all. rows aren't converted to dictionaries.
+    # flush=False is for lookups that don't need to see buffered rows. it keeps the writes batched.
+    def iterate(self, statement, parameters=None, batchSize=1000, flush=True):
+        # so reads see buffered rows
+        if flush:
+            self.flush()
+
+        with self.getLock():
+            cursor = self.getNewCursor()
 
-        for i in range(0, maximumTries):
             try:
-                self.cursor.execute(query)
+                self.executeOnCursor(cursor, statement, parameters)
 
-                # if it's here it means it succeeded
-                break
+                while True:
+                    rows = cursor.fetchmany(batchSize)
+
+                    if not rows:
+                        break
+
+                    for row in rows:
+                        yield row
             except sqlite3.OperationalError as e:
-                if str(e) == 'database is locked':
-                    logging.error(f'Database locked. Retrying. {i + 1} of {maximumTries}.')
+                self.handleException(e)
+            finally:
+                cursor.close()
 
-                    seconds = random.randrange(100, 1000) / 1000
-                    time.sleep(seconds)
-                else:
-                    self.handleException(e)
-                    break
+    # sqlite waits for locks itself for up to busy_timeout milliseconds
+    def executeAndCommit(self, query, parameters=None):
+        with self.getLock():
+            try:
+                self.executeOnCursor(self.cursor, query, parameters)
+            except sqlite3.OperationalError as e:
+                self.handleException(e)
 
-        self.connection.commit()
+            self.commit()
+
+    # the same statement text with different parameters reuses the compiled statement
+    def executeOnCursor(self, cursor, statement, parameters):
+        if parameters is None:
+            cursor.execute(statement)
+            return
+
+        if self.type == 'mysql':
+            statement = statement.replace('?', '%s')
+
+        cursor.execute(statement, parameters)
+
+    def getNewCursor(self):
+        if self.type == 'mysql':
+            return self.connection.cursor(dictionary=True, buffered=True)
+
+        return self.connection.cursor()
+
+    # commits unless inside a transaction
+    def commit(self):
+        state = self.getThreadState()
+
+        if state.transactionDepth > 0:
+            return
+
+        state.connection.commit()
+
+    # everything inside is committed once at the end or rolled back on an exception
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.getLock():
+            state = self.getThreadState()
+
+            state.transactionDepth += 1
+
+            try:
+                yield self
+            except Exception as e:
+                state.transactionDepth -= 1
+
+                if state.transactionDepth == 0:
+                    state.connection.rollback()
+
+                raise e
+
+            state.transactionDepth -= 1
+
+            self.commit()
 
     def insert(self, table, toInsert):
         if not toInsert:
@@ -97,54 +169,152 @@ class Database:
         
         if isinstance(toInsert, list):
             items = toInsert
-            toInsert = None
 
-            logging.debug(f'Inserting into {len(items)} into {table}')
+            logging.debug(f'Inserting {len(items)} items into {table}')
         else:
             logging.debug(f'Inserting into {table}: {toInsert}')
             items.append(toInsert)
 
-        columns = []
+        with self.getLock():
+            self.insertMany(table, items)
+            self.commit()
+
+    # buffers the row and writes it later together with others in one transaction
+    def insertLater(self, table, toInsert):
+        with self.lock:
+            if not table in self.buffer:
+                self.buffer[table] = []
+
+            self.buffer[table].append(toInsert)
+            self.bufferedRows += 1
 
-        for key in items[0]:
-            columns.append(key)
+            secondsSinceFlush = time.monotonic() - self.lastFlush
 
-        columns = ', '.join(columns)
+            if self.bufferedRows >= self.maximumBufferedRows or secondsSinceFlush >= self.maximumSecondsBetweenFlushes:
+                self.flush()
 
-        groupsOfValues = []
+    def flush(self):
+        with self.lock:
+            self.lastFlush = time.monotonic()
 
-        for item in items:            
+            if not self.bufferedRows:
+                return
+
+            logging.debug(f'Writing {self.bufferedRows} buffered rows to the database')
+
+            for table, items in self.buffer.items():
+                self.insertMany(table, items)
+
+            self.buffer = {}
+            self.bufferedRows = 0
+
+            self.commit()
+
+    # doesn't commit
+    def insertMany(self, table, items):
+        if not items:
+            return
+
+        columns = list(items[0].keys())
+
+        query = self.getInsertStatement(table, columns)
+
+        rows = []
+
+        for item in items:
             values = []
-            
-            for key, value in item.items():
-                # escape single quotes
-                if isinstance(value, str):
-                    value = "'" + value.replace("'", "''") + "'"
-                elif value == None:
-                    value = 'null'
 
-                values.append(str(value))
+            for column in columns:
+                values.append(self.toDatabaseValue(item.get(column, None)))
+
+            rows.append(values)
+
+        # stay under the limit on the number of variables in one statement
+        rowsPerChunk = max(1, self.maximumVariables // len(columns))
+
+        for i in range(0, len(rows), rowsPerChunk):
+            self.executeMany(query, rows[i:i + rowsPerChunk])
+
+    def getInsertStatement(self, table, columns):
+        key = (table, tuple(columns))
+
+        if key in self.insertStatements:
+            return self.insertStatements[key]
+
+        placeholder = '?'
 
-            values = ', '.join(values)
-            values = f'({values})'
+        if self.type == 'mysql':
+            placeholder = '%s'
+
+        columnsString = ', '.join(columns)
+        placeholders = ', '.join([placeholder] * len(columns))
+
+        primaryKeys = self.getPrimaryKeys(table)
+        columnsToUpdate = [column for column in columns if not column in primaryKeys]
+
+        result = f'insert into {table} ({columnsString}) values ({placeholders})'
+
+        if self.type == 'sqlite' and primaryKeys:
+            primaryKeysString = ', '.join(primaryKeys)
+
+            if columnsToUpdate:
+                updates = ', '.join([f'{column} = excluded.{column}' for column in columnsToUpdate])
+                result += f' on conflict ({primaryKeysString}) do update set {updates}'
+            else:
+                result += f' on conflict ({primaryKeysString}) do nothing'
+        elif self.type == 'mysql' and primaryKeys and columnsToUpdate:
+            updates = ', '.join([f'{column} = values({column})' for column in columnsToUpdate])
+            result += f' on duplicate key update {updates}'
 
-            groupsOfValues.append(values)
+        self.insertStatements[key] = result
 
-        groupsOfValues = ', '.join(groupsOfValues)
+        return result
 
-        query = ''
+    def getPrimaryKeys(self, table):
+        if table in self.primaryKeys:
+            return self.primaryKeys[table]
+
+        result = []
 
         if self.type == 'sqlite':
-            query = f'insert or replace into {table} ({columns}) values {groupsOfValues};'
+            rows = self.execute(f'pragma table_info({table})', True)
+
+            # pk is the position in the key. 0 means not part of it.
+            rows = sorted([row for row in rows if row['pk'] > 0], key=lambda row: row['pk'])
+
+            result = [row['name'] for row in rows]
         elif self.type == 'mysql':
-            query = f'replace into {table} ({columns}) values {groupsOfValues};'
+            rows = self.execute(f"show keys from {table} where Key_name = 'PRIMARY'", True)
+
+            rows = sorted(rows, key=lambda row: row['Seq_in_index'])
 
-        self.executeWithRetries(query)
+            result = [row['Column_name'] for row in rows]
+
+        self.primaryKeys[table] = result
+
+        return result
+
+    def toDatabaseValue(self, value):
+        if value is None or isinstance(value, (str, int, float, bytes)):
+            return value
+
+        return str(value)
+
+    def executeMany(self, query, rows):
+        with self.getLock():
+            try:
+                self.cursor.executemany(query, rows)
+            except Exception as e:
+                self.handleException(e)
 
     def makeTables(self, fileName):
         tables = helpers.getJsonFile(fileName)
 
         for tableName in tables:
+            # not a table
+            if tableName == 'migrations':
+                continue
+
             table = tables[tableName]
 
             columnList = []
@@ -165,46 +335,222 @@ class Database:
             statement = f'create table if not exists {tableName} ( {columnsString}{primaryKeysString} )'
             self.execute(statement)
 
+            # tables from older versions
+            self.addMissingColumns(tableName, columns)
+
+        self.migrate(get(tables, 'migrations'))
+
+        # after the migrations in case they change the columns
+        for tableName in tables:
+            if tableName == 'migrations':
+                continue
+
+            indexes = get(tables[tableName], 'indexes')
+
+            for indexName in indexes:
+                indexColumns = ', '.join(indexes[indexName])
+
+                self.execute(f'create index if not exists {indexName} on {tableName} ({indexColumns})')
+
+    def addMissingColumns(self, tableName, columns):
+        existingColumns = self.getColumns(tableName)
+
+        for column in columns:
+            if column in existingColumns:
+                continue
+
+            logging.info(f'Adding column {column} to {tableName}')
+            self.execute(f'alter table {tableName} add column {column} {columns[column]}')
+
+    def getColumns(self, tableName):
+        with self.getLock():
+            self.executeAndCommit(f'select * from {tableName} limit 0')
+
+            result = [column[0] for column in self.cursor.description]
+
+            self.cursor.fetchall()
+
+            return result
+
+    # runs each migration newer than the database once, in order of version
+    def migrate(self, migrations):
+        self.execute('create table if not exists schemaVersion ( version integer )')
+
+        row = self.getFirst('schemaVersion', 'max(version) as version', '')
+        currentVersion = get(row, 'version')
+
+        if not currentVersion:
+            currentVersion = 0
+
+        for migration in sorted(migrations, key=lambda migration: migration['version']):
+            version = migration['version']
+
+            if version <= currentVersion:
+                continue
+
+            logging.info(f'Updating database to version {version}: {get(migration, "description")}')
+
+            try:
+                with self.transaction():
+                    for statement in migration['statements']:
+                        self.cursor.execute(statement)
+
+                    self.cursor.execute(f'insert into schemaVersion (version) values ({version})')
+            except Exception as e:
+                self.handleException(e)
+                break
+
+            currentVersion = version
+
     def open(self, name):
         if not name:
             return
 
+        self.name = name
+
         try:
             if self.type == 'sqlite':
-                self.connection = sqlite3.connect(name)
-                # to get column names
-                self.connection.row_factory = sqlite3.Row
-                self.cursor = self.connection.cursor()
+                # connect now so errors show up here
+                self.getThreadState()
             elif self.type == 'mysql':
                 import mysql.connector                
                 
-                self.connection = mysql.connector.connect(host=get(name, 'host'), user=get(name, 'user'), passwd=get(name, 'password'))
+                state = self.sharedState
+
+                state.connection = mysql.connector.connect(host=get(name, 'host'), user=get(name, 'user'), passwd=get(name, 'password'))
                 # buffered part is because otherwise get "Unread result found" error when you connection.commit without cursor.fetchAll
-                self.cursor = self.connection.cursor(dictionary=True, buffered=True)
+                state.cursor = state.connection.cursor(dictionary=True, buffered=True)
 
-                self.cursor.execute(f'CREATE DATABASE IF NOT EXISTS {get(name, "database")} CHARACTER SET utf8 COLLATE utf8_general_ci;')
-                self.cursor.execute(f'use {get(name, "database")};')
+                state.cursor.execute(f'CREATE DATABASE IF NOT EXISTS {get(name, "database")} CHARACTER SET utf8 COLLATE utf8_general_ci;')
+                state.cursor.execute(f'use {get(name, "database")};')
 
         except Exception as e:
             self.handleException(e)
 
+    # each thread gets its own sqlite connection so readers don't wait for writers.
+    # mysql uses one connection for everything.
+    def getThreadState(self):
+        if self.type != 'sqlite':
+            return self.sharedState
+
+        state = self.local
+
+        if hasattr(state, 'connection'):
+            return state
+
+        state.connection = None
+        state.cursor = None
+        state.transactionDepth = 0
+        state.lock = threading.RLock()
+
+        if not self.name:
+            return state
+
+        # shared with close(), which may run on another thread
+        state.connection = sqlite3.connect(self.name, check_same_thread=False, cached_statements=self.maximumCachedStatements)
+        # to get column names
+        state.connection.row_factory = sqlite3.Row
+        state.cursor = state.connection.cursor()
+
+        for name, value in self.pragmas:
+            state.cursor.execute(f'pragma {name} = {value}')
+
+        with self.lock:
+            # forget connections of threads that are gone
+            for thread, connection in list(self.connections):
+                if thread.is_alive():
+                    continue
+
+                connection.close()
+                self.connections.remove((thread, connection))
+
+            self.connections.append((threading.current_thread(), state.connection))
+
+        return state
+
+    # only mysql's shared connection needs locking
+    def getLock(self):
+        return self.getThreadState().lock
+
+    @property
+    def connection(self):
+        return self.getThreadState().connection
+
+    @property
+    def cursor(self):
+        return self.getThreadState().cursor
+
+    # name=value;name=value
+    def setPragmas(self, string):
+        self.pragmas = []
+
+        for pragma in string.split(';'):
+            if not '=' in pragma:
+                continue
+
+            name = helpers.findBetween(pragma, '', '=').strip()
+            value = helpers.findBetween(pragma, '=', '').strip()
+
+            self.pragmas.append((name, value))
+
     def handleException(self, e):
         helpers.handleException(e, 'Database error')
 
     def close(self):
-        if self.connection:
-            self.connection.commit()
-            self.cursor.close()
-            self.connection.close()
+        if not self.name:
+            return
+
+        self.flush()
+
+        if self.type == 'sqlite':
+            with self.lock:
+                for thread, connection in self.connections:
+                    connection.commit()
+                    connection.close()
+
+                self.connections = []
+
+            self.local = threading.local()
+        elif self.sharedState.connection:
+            self.sharedState.connection.commit()
+            self.sharedState.cursor.close()
+            self.sharedState.connection.close()
 
-    def __init__(self, name=None, type='sqlite'):
+    def __init__(self, name=None, type='sqlite', pragmas=None):
         self.type = type
-        self.connection = None
-        self.cursor = None
+        self.name = None
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.connections = []
+        self.buffer = {}
+        self.bufferedRows = 0
+        self.lastFlush = time.monotonic()
+        self.maximumBufferedRows = 100
+        self.maximumSecondsBetweenFlushes = 10
+        self.primaryKeys = {}
+        self.insertStatements = {}
+
+        self.sharedState = types.SimpleNamespace()
+        self.sharedState.connection = None
+        self.sharedState.cursor = None
+        self.sharedState.transactionDepth = 0
+        self.sharedState.lock = self.lock
+
+        # wal lets readers and a writer work at the same time
+        self.setPragmas('journal_mode=WAL;synchronous=NORMAL;busy_timeout=30000;mmap_size=268435456;cache_size=-65536')
+
+        if pragmas:
+            self.setPragmas(pragmas)
+
+        # sqlite's default limit on variables in one statement
+        self.maximumVariables = 999
+
+        # compiled statements to keep per connection
+        self.maximumCachedStatements = 256
 
         self.stringKeyType = 'text'
 
         if self.type == 'mysql':
             self.stringKeyType = 'varchar(100)'
         
-        self.open(name)
\ No newline at end of file
+        self.open(name)
@@ -0,0 +1,20 @@
+# helpers for 64 bit similarity hashes, such as simhashes of text and perceptual hashes of pictures.
+# each hash is split into four 16 bit bands, so hashes within 3 bits of each other share at least one band.
+
+# sqlite integers are signed
+def toSigned(hash):
+    result = hash
+
+    if result >= 1 << 63:
+        result -= 1 << 64
+
+    return result
+
+def getBands(hash):
+    unsigned = hash & 0xffffffffffffffff
+
+    return [(unsigned >> (16 * i)) & 0xffff for i in range(4)]
+
+# how many bits are different
+def getDistance(first, second):
+    return bin((first ^ second) & 0xffffffffffffffff).count('1')
@@ -0,0 +1,230 @@
+import io
+import json
+import time
+import logging
+import hashlib
+import threading
+
+from . import helpers
+from . import hashbands
+
+from .helpers import get
+from .database import Database
+
+# remembers labels by exact image content and by what the image looks like, so re-encoded copies also match
+class LabelCache:
+    def get(self, hashes):
+        result = None
+
+        self.initialize()
+
+        row = self.database.getFirst('label', 'contentHash, labels', 'contentHash = ? and gmTimestamp >= ?', parameters=[hashes['contentHash'], self.getMinimumTimestamp()])
+
+        if row:
+            self.countHit('exactHits')
+        else:
+            row = self.getSimilar(hashes)
+
+            if row:
+                self.countHit('perceptualHits')
+
+        if not row:
+            self.countHit('misses')
+            return result
+
+        self.database.execute('update label set lastUsed = ? where contentHash = ?', False, [int(time.time()), row['contentHash']])
+
+        result = json.loads(row['labels'])
+
+        return result
+
+    # at most maximumDistance bits differ. that means at least one of the four 16 bit bands is identical.
+    def getSimilar(self, hashes):
+        result = {}
+
+        perceptualHash = hashes.get('perceptualHash')
+
+        if perceptualHash is None:
+            return result
+
+        bands = hashbands.getBands(perceptualHash)
+
+        rows = self.database.get('label', 'contentHash, perceptualHash, labels', 'gmTimestamp >= ? and (band0 = ? or band1 = ? or band2 = ? or band3 = ?)', '', '', None, [self.getMinimumTimestamp()] + bands)
+
+        bestDistance = self.maximumDistance + 1
+
+        for row in rows:
+            if row['perceptualHash'] is None:
+                continue
+
+            distance = hashbands.getDistance(row['perceptualHash'], perceptualHash)
+
+            if distance < bestDistance:
+                bestDistance = distance
+                result = row
+
+        return result
+
+    def put(self, hashes, labels):
+        self.initialize()
+
+        now = int(time.time())
+
+        perceptualHash = hashes.get('perceptualHash')
+        bands = [None, None, None, None]
+
+        if perceptualHash is not None:
+            bands = hashbands.getBands(perceptualHash)
+
+        newItem = {
+            'contentHash': hashes['contentHash'],
+            'perceptualHash': perceptualHash,
+            'band0': bands[0],
+            'band1': bands[1],
+            'band2': bands[2],
+            'band3': bands[3],
+            'labels': json.dumps(labels),
+            'gmTimestamp': now,
+            'lastUsed': now
+        }
+
+        self.database.insert('label', newItem)
+
+        with self.lock:
+            self.writes += 1
+
+            if self.writes % 100 == 0:
+                self.evict()
+
+    def getHashes(self, imageBytes):
+        return {
+            'contentHash': hashlib.sha256(imageBytes).hexdigest(),
+            'perceptualHash': self.getPerceptualHash(imageBytes)
+        }
+
+    # difference hash. compares neighbouring pixels of a 9x8 grayscale thumbnail.
+    def getPerceptualHash(self, imageBytes):
+        result = None
+
+        if not self.hasPillow:
+            return result
+
+        try:
+            from PIL import Image
+
+            image = Image.open(io.BytesIO(imageBytes))
+            image = image.convert('L').resize((9, 8), Image.LANCZOS)
+
+            pixels = list(image.getdata())
+
+            result = 0
+
+            for row in range(8):
+                for column in range(8):
+                    left = pixels[row * 9 + column]
+                    right = pixels[row * 9 + column + 1]
+
+                    result = (result << 1) | int(left > right)
+
+            result = hashbands.toSigned(result)
+        except Exception as e:
+            helpers.handleException(e, 'Could not get perceptual hash', None, True)
+            result = None
+
+        return result
+
+    def evict(self):
+        self.database.execute('delete from label where gmTimestamp < ?', False, [self.getMinimumTimestamp()])
+
+        row = self.database.getFirst('label', 'count(*) as count', '')
+        extra = get(row, 'count') - self.maximumEntries
+
+        if extra <= 0:
+            return
+
+        logging.debug(f'Removing {extra} least recently used labels')
+
+        self.database.execute('delete from label where contentHash in (select contentHash from label order by lastUsed asc limit ?)', False, [extra])
+
+    def getMinimumTimestamp(self):
+        return int(time.time()) - self.maximumDays * 24 * 60 * 60
+
+    def countHit(self, name):
+        with self.lock:
+            self.statistics[name] += 1
+
+    def getStatistics(self):
+        exactHits = self.statistics['exactHits']
+        perceptualHits = self.statistics['perceptualHits']
+        misses = self.statistics['misses']
+
+        total = exactHits + perceptualHits + misses
+
+        hitRate = 0
+
+        if total:
+            hitRate = (exactHits + perceptualHits) / total * 100
+
+        return f'Picture label cache. Exact hits: {exactHits}. Similar picture hits: {perceptualHits}. Misses: {misses}. Hit rate: {helpers.fixedDecimals(hitRate, 0)}%.'
+
+    def initialize(self):
+        with self.lock:
+            if self.database:
+                return
+
+            # once per run, after logging is set up
+            if not self.hasPillow and not self.hasWarned:
+                logging.warning('Pillow is not installed. Only identical pictures will match in the label cache and pictures won\'t be made smaller. Run "pip install Pillow" to fix this.')
+                self.hasWarned = True
+
+            helpers.makeDirectory(self.directory)
+
+            self.database = Database(self.directory + '/labels.sqlite')
+
+            self.database.execute('create table if not exists label ( contentHash text, perceptualHash integer, band0 integer, band1 integer, band2 integer, band3 integer, labels text, gmTimestamp integer, lastUsed integer, primary key(contentHash) )')
+
+            for i in range(4):
+                self.database.execute(f'create index if not exists label_band{i} on label (band{i})')
+
+            self.database.execute('create index if not exists label_lastUsed on label (lastUsed)')
+
+    def configure(self, options):
+        if get(options, 'labelCacheDays'):
+            self.maximumDays = options['labelCacheDays']
+
+        if get(options, 'maximumLabelCacheEntries'):
+            self.maximumEntries = options['maximumLabelCacheEntries']
+
+    def close(self):
+        with self.lock:
+            if not self.database:
+                return
+
+            logging.info(self.getStatistics())
+
+            self.database.close()
+            self.database = None
+
+    def __init__(self, directory='user-data/cache'):
+        self.directory = directory
+        self.database = None
+        self.lock = threading.RLock()
+        self.writes = 0
+
+        self.maximumDays = 30
+        self.maximumEntries = 100000
+        self.maximumDistance = 3
+
+        self.statistics = {
+            'exactHits': 0,
+            'perceptualHits': 0,
+            'misses': 0
+        }
+
+        self.hasPillow = True
+        self.hasWarned = False
+
+        try:
+            import PIL
+        except ImportError:
+            self.hasPillow = False
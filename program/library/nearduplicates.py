@@ -0,0 +1,174 @@
+import re
+import time
+import hashlib
+
+from . import hashbands
+
+# finds listings that are almost the same as ones seen before, such as reposts in other cities.
+# 64 bit simhashes. the four 16 bit bands are indexed, so a hash within 3 bits shares at least one band.
+# a verdict only carries over between listings that were checked for the same keyword with the same filters.
+class NearDuplicates:
+    # kind is title or text. hashes has what's known about the listing so far.
+    def find(self, siteName, scope, idInWebsite, kind, hashes, price=None):
+        result = {}
+
+        hash = hashes.get(kind)
+
+        if hash is None:
+            return result
+
+        bands = hashbands.getBands(hash)
+
+        parameters = [siteName, scope, kind]
+        conditions = []
+
+        for i, band in enumerate(bands):
+            conditions.append('(b.band = ? and b.value = ?)')
+            parameters += [i, band]
+
+        parameters.append(idInWebsite)
+
+        column = kind + 'Hash'
+
+        rows = self.database.getRows(f'select distinct d.* from nearDuplicateBand b join nearDuplicate d on d.siteName = b.siteName and d.scope = b.scope and d.idInWebsite = b.idInWebsite where b.siteName = ? and b.scope = ? and b.kind = ? and ({" or ".join(conditions)}) and d.idInWebsite != ?', parameters, False)
+
+        for row in rows:
+            if row[column] is None:
+                continue
+
+            if hashbands.getDistance(row[column], hash) > self.maximumDistance:
+                continue
+
+            if not self.agrees(row, kind, hashes, price):
+                continue
+
+            result = row
+            break
+
+        return result
+
+    def findByPicture(self, siteName, scope, idInWebsite, hashes, price=None):
+        result = {}
+
+        pictureKey = hashes.get('picture')
+
+        if not pictureKey:
+            return result
+
+        rows = self.database.get('nearDuplicate', '*', 'siteName = ? and scope = ? and pictureKey = ? and idInWebsite != ?', '', '', None, [siteName, scope, pictureKey, idInWebsite], False)
+
+        for row in rows:
+            if not self.agrees(row, 'picture', hashes, price):
+                continue
+
+            result = row
+            break
+
+        return result
+
+    # one similar field isn't enough. short titles and stock pictures are often the same by chance.
+    def agrees(self, row, kind, hashes, price):
+        if price is not None and row['price'] == price:
+            return True
+
+        pictureKey = hashes.get('picture')
+
+        if kind != 'picture' and pictureKey and row['pictureKey'] == pictureKey:
+            return True
+
+        titleHash = hashes.get('title')
+
+        if kind != 'title' and titleHash is not None and row['titleHash'] is not None:
+            return hashbands.getDistance(row['titleHash'], titleHash) <= self.maximumDistance
+
+        return False
+
+    def add(self, siteName, scope, idInWebsite, hashes, price, matches):
+        now = int(time.time())
+
+        self.database.insertLater('nearDuplicate', {
+            'siteName': siteName,
+            'scope': scope,
+            'idInWebsite': idInWebsite,
+            'titleHash': hashes.get('title'),
+            'textHash': hashes.get('text'),
+            'pictureKey': hashes.get('picture', ''),
+            'price': price,
+            'matches': matches,
+            'gmTimestamp': now
+        })
+
+        for kind in ['title', 'text']:
+            hash = hashes.get(kind)
+
+            if hash is None:
+                continue
+
+            for i, band in enumerate(hashbands.getBands(hash)):
+                self.database.insertLater('nearDuplicateBand', {
+                    'siteName': siteName,
+                    'scope': scope,
+                    'kind': kind,
+                    'band': i,
+                    'value': band,
+                    'idInWebsite': idInWebsite,
+                    'gmTimestamp': now
+                })
+
+    # each word or group of words votes on each bit. short texts are too likely to be the same by chance.
+    def getSimHash(self, text, wordsPerFeature=1, minimumWords=1):
+        result = None
+
+        words = re.findall(r'\w+', text.casefold())
+
+        if len(words) < max(minimumWords, wordsPerFeature):
+            return result
+
+        counts = [0] * 64
+
+        for i in range(len(words) - wordsPerFeature + 1):
+            feature = ' '.join(words[i:i + wordsPerFeature])
+
+            # python's hash() changes between runs, so can't be stored
+            h = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+
+            for bit in range(64):
+                if h & (1 << bit):
+                    counts[bit] += 1
+                else:
+                    counts[bit] -= 1
+
+        result = 0
+
+        for bit in range(64):
+            if counts[bit] > 0:
+                result |= 1 << bit
+
+        result = hashbands.toSigned(result)
+
+        return result
+
+    # the keyword and the filters that decide whether a listing matches
+    def getScope(self, item):
+        fields = [' '.join(item.get('keyword', '').casefold().split())]
+
+        for name in ['craigslist category', 'craigslist ad must contain', 'craigslist ad must not contain', 'picture must contain one of', 'picture confidence %']:
+            fields.append(item.get(name, ''))
+
+        return hashlib.sha1('\n'.join(fields).encode('utf-8')).hexdigest()[:16]
+
+    # the same picture file has the same name in every size
+    def getPictureKey(self, url):
+        result = ''
+
+        if not url:
+            return result
+
+        result = url.split('/')[-1]
+        result = re.sub(r'_\d+x\d+c?(\.\w+)$', '', result)
+
+        return result
+
+    def __init__(self, database, maximumDistance=3):
+        self.database = database
+        self.maximumDistance = maximumDistance
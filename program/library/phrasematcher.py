@@ -0,0 +1,51 @@
+import re
+
+# finds which of a list of phrases a text contains, ignoring case.
+# the phrases are folded once into one regular expression, so the text is only scanned once however many phrases there are.
+# the text is folded too. that's much faster than re.IGNORECASE.
+class PhraseMatcher:
+    def search(self, text):
+        return self.searchFolded(self.fold(text))
+
+    # for when the same text is checked against several matchers
+    def searchFolded(self, foldedText):
+        result = None
+
+        if not self.expression:
+            return result
+
+        match = self.expression.search(foldedText)
+
+        if match:
+            result = self.phrasesByFolded[match.group(0)]
+
+        return result
+
+    def fold(self, text):
+        return text.casefold()
+
+    def __bool__(self):
+        return len(self.phrases) > 0
+
+    def __init__(self, string, separator=';'):
+        self.phrases = []
+        self.phrasesByFolded = {}
+        self.expression = None
+
+        if not string:
+            return
+
+        for phrase in string.split(separator):
+            folded = self.fold(phrase)
+
+            if folded in self.phrasesByFolded:
+                continue
+
+            self.phrases.append(phrase)
+            self.phrasesByFolded[folded] = phrase
+
+        # an empty phrase never counted as found
+        alternatives = [re.escape(folded) for folded in self.phrasesByFolded if folded]
+
+        if alternatives:
+            self.expression = re.compile('|'.join(alternatives))
@@ -0,0 +1,189 @@
+import re
+
+# turns the input rows into as few craigslist searches as possible.
+# a target is one input row with its own price range. a query is one search that several targets share.
+class QueryPlanner:
+    def add(self, site, item, minimumPrice, maximumPrice):
+        self.targets.append({
+            'site': site,
+            'item': item,
+            'keyword': self.normalize(item.get('keyword', '')),
+            'category': item.get('craigslist category', '') or 'sss',
+            'minimumPrice': minimumPrice,
+            'maximumPrice': maximumPrice
+        })
+
+    def getQueries(self):
+        result = []
+
+        groups = {}
+
+        # the same keyword in a category that contains the other categories
+        for target in self.targets:
+            category = self.getWidestCategory(target)
+
+            key = (target['site'], category)
+
+            groups.setdefault(key, []).append(target)
+
+        for key, targets in groups.items():
+            site, category = key
+
+            for window in self.getPriceWindows(targets):
+                for keywords in self.getKeywordGroups(window):
+                    queryTargets = [target for target in window if target['keyword'] in keywords]
+
+                    result.append(self.getQuery(site, category, keywords, queryTargets))
+
+        return result
+
+    def getQuery(self, site, category, keywords, targets):
+        keyword = keywords[0]
+
+        # craigslist: | means or and parentheses group words
+        if len(keywords) > 1:
+            keyword = '|'.join(f'({s})' for s in keywords)
+
+        return {
+            'site': site,
+            'keyword': keyword,
+            'craigslist category': category,
+            'keywords': keywords,
+            'minimumPrice': min(target['minimumPrice'] for target in targets),
+            'maximumPrice': max(target['maximumPrice'] for target in targets),
+            'targets': targets,
+            'requests': 0
+        }
+
+    # sss contains everything. moa (all cell phones) contains mob (by owner) and mod (by dealer) and so on.
+    def getWidestCategory(self, target):
+        result = target['category']
+
+        for other in self.targets:
+            if other['site'] != target['site'] or other['keyword'] != target['keyword']:
+                continue
+
+            if self.contains(other['category'], result):
+                result = other['category']
+
+        return result
+
+    def contains(self, category, otherCategory):
+        if category == otherCategory or category == 'sss':
+            return True
+
+        return len(category) == 3 and category.endswith('a') and otherCategory[:2] == category[:2]
+
+    # price ranges that overlap are searched together. a gap between them would only bring unwanted listings.
+    def getPriceWindows(self, targets):
+        result = []
+
+        end = None
+
+        for target in sorted(targets, key=lambda target: target['minimumPrice']):
+            if end is None or target['minimumPrice'] > end + 1:
+                result.append([])
+                end = target['maximumPrice']
+
+            result[-1].append(target)
+            end = max(end, target['maximumPrice'])
+
+        return result
+
+    # keywords with search operators of their own are searched alone
+    def getKeywordGroups(self, targets):
+        result = []
+
+        keywords = []
+
+        for target in targets:
+            if not target['keyword'] in keywords:
+                keywords.append(target['keyword'])
+
+        group = []
+
+        for keyword in keywords:
+            if re.search(r'[|()"*-]', keyword) or not keyword:
+                result.append([keyword])
+                continue
+
+            if len(group) >= max(1, self.maximumKeywordsPerSearch):
+                result.append(group)
+                group = []
+
+            group.append(keyword)
+
+        if group:
+            result.append(group)
+
+        return result
+
+    # the input rows that want a listing from the search results. text is only needed when the title doesn't say.
+    def getTargets(self, query, newItem, text=None):
+        result = []
+
+        category = self.getListingCategory(newItem.get('url', ''))
+
+        for target in query['targets']:
+            # the search was in a wider category than this row wants
+            if target['category'] != query['craigslist category']:
+                if not category or not self.contains(target['category'], category):
+                    continue
+
+            if len(query['keywords']) > 1:
+                if text is None:
+                    text = newItem.get('name', '')
+
+                if not self.hasWords(text, target['keyword']):
+                    continue
+
+            result.append(target)
+
+        return result
+
+    # whole words, so "x" isn't found in "max"
+    def hasWords(self, text, keyword):
+        words = set(re.findall(r'\w+', text.casefold()))
+
+        for word in re.findall(r'\w+', keyword):
+            if not word in words:
+                return False
+
+        return True
+
+    # https://city.craigslist.org/mob/d/title/123.html
+    def getListingCategory(self, url):
+        result = ''
+
+        fields = url.split('/')
+
+        if not 'd' in fields:
+            return result
+
+        index = fields.index('d')
+
+        if index > 0 and re.fullmatch(r'[a-z]{3}', fields[index - 1]):
+            result = fields[index - 1]
+
+        return result
+
+    def normalize(self, keyword):
+        return ' '.join(keyword.casefold().split())
+
+    def getSummary(self, queries):
+        made = 0
+        withoutPlan = 0
+
+        for query in queries:
+            made += query['requests']
+            # each row would have needed about the same searches on its own
+            withoutPlan += query['requests'] * len(query['targets'])
+
+        saved = withoutPlan - made
+
+        return f'Searched {len(self.targets)} input rows with {len(queries)} searches. Made {made} search requests. Saved about {saved} requests.'
+
+    def __init__(self, options):
+        self.targets = []
+
+        self.maximumKeywordsPerSearch = options.get('maximumKeywordsPerSearch', 4)
@@ -0,0 +1,111 @@
+# compares ways to check a listing's text against the word filters.
+# run it with python tests/benchmark_phrasematcher.py. it's not collected by pytest.
+import os
+import re
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from program.library.phrasematcher import PhraseMatcher
+
+# about the size of the text of a craigslist listing page
+def getListingText(size=4000):
+    random.seed(1)
+
+    words = ['iphone', 'unlocked', 'screen', 'battery', 'charger', 'case', 'condition', 'great', 'works', 'pickup', 'downtown', 'text', 'me', 'price', 'firm', 'scratches', 'the', 'and', 'with', 'for', 'Apple', 'Verizon', 'GB', 'model']
+
+    result = []
+    length = 0
+
+    while length < size:
+        word = random.choice(words)
+        result.append(word)
+        length += len(word) + 1
+
+    return ' '.join(result)
+
+# phrases that aren't in the text, so every phrase is checked
+def getPhrases(count, prefix='phrase number'):
+    return ';'.join(f'{prefix} {i}' for i in range(count))
+
+# what passesWordFilters did before PhraseMatcher
+def containsCaseInsensitive(string, text):
+    result = None
+
+    if not string:
+        return result
+
+    text = text.lower()
+
+    for item in string.split(';'):
+        if item.lower() in text:
+            result = item
+            break
+
+    return result
+
+# folded phrases prepared once, one substring search each
+def getSubstringLoop(string):
+    phrases = [phrase.casefold() for phrase in string.split(';')]
+
+    def search(text):
+        text = text.casefold()
+
+        for phrase in phrases:
+            if phrase in text:
+                return phrase
+
+    return search
+
+def getIgnoreCaseExpression(string):
+    return re.compile('|'.join(re.escape(phrase) for phrase in string.split(';')), re.IGNORECASE)
+
+def getMicroseconds(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1000 * 1000
+
+def main():
+    text = getListingText()
+    number = 2000
+
+    print(f'Text: {len(text)} characters. Microseconds per listing, best of 5.')
+    print()
+    print('Phrases  Split and lower  Substring loop  re.IGNORECASE  PhraseMatcher')
+
+    for count in [2, 5, 20, 100]:
+        string = getPhrases(count)
+
+        loop = getSubstringLoop(string)
+        expression = getIgnoreCaseExpression(string)
+        matcher = PhraseMatcher(string)
+
+        times = [
+            getMicroseconds(lambda: containsCaseInsensitive(string, text), number),
+            getMicroseconds(lambda: loop(text), number),
+            getMicroseconds(lambda: expression.search(text), number),
+            getMicroseconds(lambda: matcher.search(text), number)
+        ]
+
+        print(f'{count:7}  {times[0]:15.1f}  {times[1]:14.1f}  {times[2]:13.1f}  {times[3]:13.1f}')
+
+    # a row with both lists. the text is only folded once for both.
+    toFindString = getPhrases(5)
+    toAvoidString = getPhrases(5, 'avoid')
+
+    toFind = PhraseMatcher(toFindString)
+    toAvoid = PhraseMatcher(toAvoidString)
+
+    def checkBoth():
+        folded = toFind.fold(text)
+        toFind.searchFolded(folded)
+        toAvoid.searchFolded(folded)
+
+    before = getMicroseconds(lambda: (containsCaseInsensitive(toFindString, text), containsCaseInsensitive(toAvoidString, text)), number)
+    after = getMicroseconds(checkBoth, number)
+
+    print()
+    print(f'Both lists with 5 phrases each. Before: {before:.1f}. PhraseMatcher: {after:.1f}.')
+
+if __name__ == '__main__':
+    main()
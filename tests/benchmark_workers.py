@@ -0,0 +1,197 @@
+# measures how results per minute grow with maximumWorkers.
+# the cities are served by a local stand-in for craigslist that takes a fixed time to answer each request, like a real site does. nothing is sent to craigslist.
+# run it with python tests/benchmark_workers.py. it's not collected by pytest.
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import http.server
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, root)
+
+# the program reads its resources relative to the working directory
+os.chdir(root)
+
+from marketplaces import Craigslist
+from program.library.database import Database
+
+# seconds the stand-in server takes for each request
+secondsPerRequest = 0.03
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(secondsPerRequest)
+
+        match = re.match(r'/city(\d+)/search/', self.path)
+
+        if match:
+            self.send(self.getSearchPage(int(match.group(1))))
+            return
+
+        match = re.match(r'/city(\d+)/d/phone/(\d+)\.html', self.path)
+
+        if match:
+            self.send(self.getListingPage(match.group(2)))
+            return
+
+        self.send('', code=404)
+
+    # the reply button
+    def do_POST(self):
+        time.sleep(secondsPerRequest)
+
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        self.send(json.dumps({'replyContent': '<a href="mailto:seller@example.com">seller@example.com</a>'}), 'application/json')
+
+    def getSearchPage(self, city):
+        port = self.server.server_address[1]
+
+        rows = ''
+
+        for i in range(self.server.listingsPerCity):
+            id = city * 1000 + i
+
+            rows += f'<li class="result-row"><a class="result-title" href="http://127.0.0.1:{port}/city{city}/d/phone/{id}.html">iphone x {id}</a><span class="result-price">$100</span></li>'
+
+        return f'<html><body><span class="totalcount">{self.server.listingsPerCity}</span><ul class="rows">{rows}</ul></body></html>'
+
+    def getListingPage(self, id):
+        return f'<html><body><section id="postingbody">unlocked iphone x {id}, works great</section><button data-href="/__SERVICE_ID__/{id}">reply</button></body></html>'
+
+    def send(self, body, contentType='text/html', code=200):
+        body = body.encode('utf-8')
+
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *arguments):
+        pass
+
+def startServer(listingsPerCity):
+    result = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    result.daemon_threads = True
+    result.listingsPerCity = listingsPerCity
+
+    threading.Thread(target=result.serve_forever, daemon=True).start()
+
+    return result
+
+def getOptions(workers, directory):
+    return {
+        'maximumWorkers': workers,
+        'maximumResultsPerKeyword': -1,
+        'onlyOutputPictureMatches': 0,
+        'outputDirectory': directory,
+        'sites': ['https://www.craigslist.org/'],
+        'incrementalCrawl': 1,
+        'maximumPagesPerCity': 5,
+        'maximumPriceBands': 16,
+        'maximumBandWorkers': 4,
+        'featureStoreDays': 7,
+        'citiesPerSearch': 1000,
+        'cityRevisitDays': 7,
+        'maximumPictureWorkers': 0,
+        'maximumPicturesInFlight': 1,
+        'maximumPictureDownloads': 1,
+        'maximumLabelDetections': 1,
+        'maximumPictureKilobytes': 500,
+        'picturesPerListing': 1,
+        'pictureSize': '300x300',
+        'maximumNotificationEmailsPerDay': 0,
+        'fromEmailAddress': '',
+        'toEmailAddress': '',
+        # the stand-in server's delay is the only limit
+        'requestsPerMinutePerHost': 1000000,
+        'requestsPerMinutePerDomain': 1000000,
+        'requestBurst': 1000,
+        'connectionsPerSession': 64
+    }
+
+def getItem():
+    return {
+        'keyword': 'iphone x',
+        'craigslist category': 'moa',
+        'min price': '10',
+        'min profit': '20',
+        'shipping cost': '5',
+        'hours between runs': '24',
+        'picture must contain one of': '',
+        'picture confidence %': '90',
+        'craigslist ad must contain': 'unlocked',
+        'craigslist ad must not contain': 'cash only',
+        'email subject': '',
+        'email body': ''
+    }
+
+# each run starts from an empty database, so every listing is new.
+# the search runs in a temporary directory because the program writes its logs to the working directory.
+def search(server, cities, workers):
+    directory = tempfile.mkdtemp()
+
+    try:
+        database = Database(os.path.join(directory, 'database.sqlite'))
+        database.makeTables('program/resources/database.json')
+
+        craigslist = Craigslist(getOptions(workers, directory), None)
+
+        port = server.server_address[1]
+        craigslist.siteInformation = {'cities': [{'name': f'city {i}', 'url': f'http://127.0.0.1:{port}/city{i}'} for i in range(cities)]}
+
+        os.chdir(directory)
+
+        start = time.monotonic()
+
+        craigslist.search(1, 'https://www.craigslist.org/', getItem(), database, 200)
+
+        seconds = time.monotonic() - start
+
+        results = sum(craigslist.resultCounts.values())
+
+        database.close()
+    finally:
+        os.chdir(root)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results, seconds
+
+def main():
+    logging.disable(logging.WARNING)
+
+    cities = 16
+    listingsPerCity = 5
+
+    server = startServer(listingsPerCity)
+
+    print(f'{cities} cities with {listingsPerCity} listings each. The stand-in server takes {secondsPerRequest} seconds per request.')
+    print()
+    print('Workers  Results  Seconds  Results per minute  Speedup')
+
+    baseline = None
+
+    for workers in [1, 2, 4, 8, 16]:
+        results, seconds = search(server, cities, workers)
+
+        perMinute = results / seconds * 60
+
+        if baseline is None:
+            baseline = perMinute
+
+        print(f'{workers:7}  {results:7}  {seconds:7.1f}  {perMinute:18.0f}  {perMinute / baseline:7.1f}')
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, root)
+
+# the program reads its resources relative to the working directory
+@pytest.fixture(autouse=True)
+def workingDirectory(monkeypatch):
+    monkeypatch.chdir(root)
@@ -0,0 +1,58 @@
+import time
+import email.utils
+
+from program.library.api import Api, RateLimiter
+
+class Response:
+    def __init__(self, retryAfter):
+        self.headers = {'retry-after': retryAfter}
+
+class Bucket:
+    minimumRate = 1 / 30
+
+def getRetryAfter(retryAfter, options=None):
+    rateLimiter = RateLimiter()
+    rateLimiter.configure(options or {})
+
+    return rateLimiter.getRetryAfter(Response(retryAfter), Bucket())
+
+def test_retry_after_seconds():
+    assert getRetryAfter('120') == 120
+
+def test_retry_after_date():
+    date = email.utils.formatdate(time.time() + 90, usegmt=True)
+
+    assert 80 < getRetryAfter(date) <= 90
+
+def test_retry_after_date_in_the_past():
+    date = email.utils.formatdate(time.time() - 90, usegmt=True)
+
+    assert getRetryAfter(date) == 0
+
+def test_retry_after_unknown_format():
+    assert getRetryAfter('soon') == 30
+    assert getRetryAfter('') == 30
+
+def test_retry_after_is_capped():
+    assert getRetryAfter('Wed, 21 Oct 2099 07:28:00 GMT') == 600
+    assert getRetryAfter('100000', {'maximumRetryAfterSeconds': 60}) == 60
+
+class StreamedResponse:
+    url = 'https://images.craigslist.org/a_300x300.jpg'
+
+    def iter_content(self, chunkSize):
+        for i in range(4):
+            yield b'0' * 1000
+
+    def close(self):
+        pass
+
+# the budget counts what was downloaded, even when the picture was too big to use
+def test_read_limited_returns_bytes_read():
+    response = StreamedResponse()
+
+    assert Api().readLimited(response, 2500) == 3000
+    assert response._content == b''
+
+    assert Api().readLimited(response, 5000) == 4000
+    assert len(response._content) == 4000
@@ -0,0 +1,178 @@
+import boto3
+import pytest
+
+from botocore.stub import ANY, Stubber
+
+import program.library.aws as aws
+
+from marketplaces import Craigslist
+from program.library.aws import Aws
+from program.library.labelcache import LabelCache
+
+# returns fixed labels instead of calling rekognition
+class StubAws:
+    def detectLabels(self, imageBytes):
+        self.calls += 1
+
+        return self.labels
+
+    def close(self):
+        pass
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.calls = 0
+
+def getOptions(**options):
+    result = {
+        'maximumPictureWorkers': 0,
+        'maximumPicturesInFlight': 1,
+        'maximumPictureDownloads': 1,
+        'maximumLabelDetections': 1,
+        'maximumPictureKilobytes': 500,
+        'picturesPerListing': 1,
+        'labelCacheDays': 30,
+        'maximumLabelCacheEntries': 100
+    }
+
+    result.update(options)
+
+    return result
+
+def getCraigslist(detector, options=None):
+    result = Craigslist(options or getOptions(), None, detector)
+    result.getPicture = lambda url: b'picture ' + url.encode('utf-8')
+    result.startPictureStage()
+
+    return result
+
+def getListing(craigslist, urls):
+    result = craigslist.getNewListing()
+    result['url'] = 'https://city.craigslist.org/mob/d/phone/1.html'
+    result['pictureUrls'] = urls
+
+    return result
+
+def getItem(thingsToFind='cell phone', minimumConfidence='90'):
+    return {
+        'picture must contain one of': thingsToFind,
+        'picture confidence %': minimumConfidence
+    }
+
+# labels are cached by picture, so each test needs its own cache
+@pytest.fixture(autouse=True)
+def labelCache(tmp_path, monkeypatch):
+    result = LabelCache(str(tmp_path))
+
+    monkeypatch.setattr(aws, 'labelCache', result)
+
+    yield result
+
+    result.close()
+
+def test_stubbed_detector_match():
+    detector = StubAws([{'Name': 'Cell Phone', 'Confidence': 97.2}])
+    craigslist = getCraigslist(detector)
+    listing = getListing(craigslist, ['https://images.craigslist.org/a_600x450.jpg'])
+
+    assert craigslist.picturePassesFilters(getItem(), listing)
+    assert listing['pictureContains'] == 'cell phone'
+    assert listing['pictureConfidence'] == '97'
+    assert detector.calls == 1
+
+def test_stubbed_detector_low_confidence():
+    detector = StubAws([{'Name': 'Cell Phone', 'Confidence': 61.0}])
+    craigslist = getCraigslist(detector)
+    listing = getListing(craigslist, ['https://images.craigslist.org/a_600x450.jpg'])
+
+    assert not craigslist.picturePassesFilters(getItem(), listing)
+    assert listing['pictureContains'] == ''
+    assert listing['thingsInImage'] == detector.labels
+
+def test_stubbed_detector_checks_later_pictures():
+    detector = StubAws([{'Name': 'Box', 'Confidence': 99.0}])
+    craigslist = getCraigslist(detector, getOptions(picturesPerListing=2))
+    listing = getListing(craigslist, ['https://images.craigslist.org/a_600x450.jpg', 'https://images.craigslist.org/b_600x450.jpg'])
+
+    try:
+        assert not craigslist.picturePassesFilters(getItem(), listing)
+    finally:
+        craigslist.stopPictureStage()
+
+    assert detector.calls == 2
+    assert sorted(listing['labels']) == listing['pictureUrls']
+
+# the real Aws class with a rekognition response in the format the service sends
+def test_rekognition_response():
+    client = boto3.client('rekognition', region_name='us-east-2', aws_access_key_id='test', aws_secret_access_key='test')
+
+    response = {
+        'Labels': [
+            {'Name': 'Electronics', 'Confidence': 99.1, 'Instances': [], 'Parents': []},
+            {'Name': 'Mobile Phone', 'Confidence': 95.4, 'Instances': [], 'Parents': [{'Name': 'Electronics'}]}
+        ],
+        'LabelModelVersion': '3.0'
+    }
+
+    with Stubber(client) as stubber:
+        stubber.add_response('detect_labels', response, {'Image': {'Bytes': ANY}})
+
+        craigslist = getCraigslist(Aws(getOptions(), client))
+        listing = getListing(craigslist, ['https://images.craigslist.org/a_600x450.jpg'])
+
+        assert craigslist.picturePassesFilters(getItem('cell phone;mobile phone'), listing)
+
+        stubber.assert_no_pending_responses()
+
+    assert listing['pictureContains'] == 'mobile phone'
+    assert [label['Name'] for label in listing['thingsInImage']] == ['Electronics', 'Mobile Phone']
+
+# the same picture again is answered from the label cache without calling rekognition
+def test_rekognition_response_is_cached():
+    client = boto3.client('rekognition', region_name='us-east-2', aws_access_key_id='test', aws_secret_access_key='test')
+
+    with Stubber(client) as stubber:
+        stubber.add_response('detect_labels', {'Labels': [{'Name': 'Mobile Phone', 'Confidence': 95.4}]}, {'Image': {'Bytes': ANY}})
+
+        detector = Aws(getOptions(), client)
+
+        first = detector.detectLabels(b'picture')
+        second = detector.detectLabels(b'picture')
+
+        stubber.assert_no_pending_responses()
+
+    assert first == second
+
+# throttling counts as no labels and isn't cached, so the picture is checked again next time
+def test_rekognition_throttled():
+    client = boto3.client('rekognition', region_name='us-east-2', aws_access_key_id='test', aws_secret_access_key='test')
+
+    with Stubber(client) as stubber:
+        stubber.add_client_error('detect_labels', 'ThrottlingException', 'Rate exceeded', 400)
+        stubber.add_response('detect_labels', {'Labels': [{'Name': 'Mobile Phone', 'Confidence': 95.4}]}, {'Image': {'Bytes': ANY}})
+
+        detector = Aws(getOptions(), client)
+
+        first = detector.detectLabels(b'picture')
+        second = detector.detectLabels(b'picture')
+
+        stubber.assert_no_pending_responses()
+
+    assert first == []
+    assert second == [{'Name': 'Mobile Phone', 'Confidence': 95.4}]
+
+# the smaller version of the picture is downloaded instead of the one in the listing
+def test_small_picture_url():
+    craigslist = Craigslist(getOptions(pictureSize='300x300'), None, StubAws([]))
+
+    urls = []
+
+    def getBinary(url, maximumBytes):
+        urls.append(url)
+
+        return b'picture'
+
+    craigslist.api.getBinary = getBinary
+
+    assert craigslist.getPicture('https://images.craigslist.org/00a0a_abc_600x450.jpg') == b'picture'
+    assert urls == ['https://images.craigslist.org/00a0a_abc_300x300.jpg']